@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#
+# Copyright 2009 Paul J. Davis <paul.joseph.davis@gmail.com>
+#
+# This file is part of the run package released under the BSD license.
+#
+import multiprocessing
+import operator
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import runfunc as rf
+
+class Help(rf.Help):
+    """\
+    Time a word count over a large file with MapReduce for an increasing
+    number of worker processes.
+    """
+    size = rf.Check(int, "Size of the test file in megabytes.", opt='s')
+    workers = rf.Check(int, "Largest number of workers to try.", opt='w')
+    chunk = rf.Check(int, "Range size in megabytes.", opt='c')
+
+def count(infile=None):
+    total = 0
+    for line in infile:
+        total += len(line.split())
+    return total
+
+def timed(path, workers, chunk):
+    mapreduce = rf.MapReduce("infile", operator.add, workers, chunk)
+    start = time.time()
+    with open(path) as handle:
+        words = mapreduce.call(count, {"infile": handle})
+    return time.time() - start, words
+
+def main(size=256, workers=multiprocessing.cpu_count(), chunk=16):
+    fd, path = tempfile.mkstemp(suffix=".txt")
+    try:
+        line = "the quick brown fox jumps over the lazy dog\n"
+        block = line * (1024 * 1024 / len(line))
+        with os.fdopen(fd, "w") as handle:
+            for i in range(size):
+                handle.write(block)
+
+        base = None
+        count = 1
+        while count <= workers:
+            elapsed, words = timed(path, count, chunk * 1024 * 1024)
+            base = base or elapsed
+            print "%3d workers %8.3fs %6.2fx (%d words)" % (
+                count, elapsed, base / elapsed, words)
+            count *= 2
+    finally:
+        os.remove(path)
+
+rf.run(main, Help())
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# Copyright 2009 Paul J. Davis <paul.joseph.davis@gmail.com>
+#
+# This file is part of the run package released under the BSD license.
+#
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import runfunc as rf
+
+class Help(rf.Help):
+    """\
+    Measure construction time and memory of Help classes and Parsers as the
+    number of options grows. Each count runs in a fresh process.
+    """
+    counts = rf.Numbers("Option counts to measure.", opt='c', ndarray=False)
+    depth = rf.Check(int, "Number of Help subclasses to stack.", opt='d')
+    child = rf.Check(int, "Run a single measurement.")
+
+def rss():
+    try:
+        with open("/proc/self/statm") as handle:
+            pages = int(handle.read().split()[1])
+        return pages * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measure(count, depth):
+    results = []
+    def phase(label, func):
+        mem, start = rss(), time.time()
+        ret = func()
+        results.append((label, time.time() - start, rss() - mem))
+        return ret
+
+    def build():
+        attrs = {}
+        for idx in range(count):
+            attrs["opt_%d" % idx] = rf.Check(int, "Option number %d." % idx)
+        attrs["all_options"] = True
+        return type("Help", (rf.Help,), attrs)
+    base = phase("help class", build)
+
+    def subclass():
+        classes = [base]
+        for idx in range(depth):
+            attrs = {"extra_%d" % idx: rf.Flag("Extra flag.")}
+            classes.append(type("Help%d" % idx, (classes[-1],), attrs))
+        return classes[-1]
+    help = phase("subclasses", subclass)
+
+    def main(**opts):
+        return opts
+    parser = phase("parser", lambda: rf.Parser(main, help()))
+    argv = ['--opt-0', '1', '--opt-%d' % (count - 1), '2']
+    phase("parse", lambda: parser.parse(argv))
+    phase("help render", lambda: parser.format_help(parser.formatter))
+    phase("help cached", parser.format_help)
+    phase("help again", parser.format_help)
+
+    for label, secs, mem in results:
+        print "%7d %-12s %9.2fms %9.1fKiB" % (count, label, secs * 1000,
+                                                mem / 1024.0)
+
+def main(counts=None, depth=10, child=None):
+    if child is not None:
+        return measure(child, depth)
+    print "%7s %-12s %11s %12s" % ("options", "phase", "time", "memory")
+    for count in counts or [100, 1000, 10000, 50000]:
+        cmd = [sys.executable, __file__, "--child", str(count),
+                    "--depth", str(depth)]
+        subprocess.check_call(cmd)
+
+rf.run(main, Help())
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#
+# Copyright 2009 Paul J. Davis <paul.joseph.davis@gmail.com>
+#
+# This file is part of the run package released under the BSD license.
+#
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import runfunc as rf
+
+class Help(rf.Help):
+    """\
+    Time building a Help class with many Regexp arguments and parsing one
+    of them, with patterns compiled lazily through the shared cache and
+    with every pattern compiled up front as each Regexp used to.
+    """
+    count = rf.Check(int, "Number of Regexp arguments.", opt='c')
+    classes = rf.Check(int, "Help classes declaring the same patterns.",
+                        opt='k')
+
+def sources(count):
+    return [r"^(?:opt%d|alias%d)-[a-z0-9_]{2,16}(?:\.\d+)?$" % (i, i)
+                for i in range(count)]
+
+def build(patterns, eager):
+    attrs = {}
+    for idx, source in enumerate(patterns):
+        if eager:
+            source = re.compile(source)
+        attrs["opt_%d" % idx] = rf.Regexp(source, "Option %d." % idx)
+    attrs["all_options"] = True
+    return type("Help", (rf.Help,), attrs)
+
+def timed(label, patterns, classes, eager):
+    re.purge()
+    rf.PATTERNS.clear()
+    start = time.time()
+    for i in range(classes):
+        help = build(patterns, eager)
+    built = time.time()
+    parser = rf.Parser(lambda **opts: opts, help())
+    parser.parse(["--opt-0", "opt0-value"])
+    done = time.time()
+    print "%-8s %10.2fms %10.2fms" % (label, (built - start) * 1000,
+                                        (done - built) * 1000)
+
+def main(count=500, classes=4):
+    patterns = sources(count)
+    print "%-8s %12s %12s" % ("mode", "help classes", "parse")
+    timed("eager", patterns, classes, True)
+    timed("lazy", patterns, classes, False)
+
+rf.run(main, Help())
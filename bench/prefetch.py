@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+#
+# Copyright 2009 Paul J. Davis <paul.joseph.davis@gmail.com>
+#
+# This file is part of the run package released under the BSD license.
+#
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import runfunc as rf
+
+class Help(rf.Help):
+    """\
+    Compare reading a large file with plain open() against a prefetching
+    Stream. A per-read delay stands in for a slow or networked filesystem.
+    """
+    size = rf.Check(int, "Size of the test file in megabytes.", opt='s')
+    delay = rf.Check(float, "Seconds to sleep on every raw read.", opt='d')
+    chunk = rf.Check(int, "Raw read size in kilobytes.", opt='c')
+
+class SlowFile(io.FileIO):
+    delay = 0.0
+    def readinto(self, buf):
+        if self.delay:
+            time.sleep(self.delay)
+        return io.FileIO.readinto(self, buf)
+
+def consume(stream):
+    total = 0
+    for line in stream:
+        total += len(line.split())
+    return total
+
+def timed(label, stream):
+    start = time.time()
+    with stream:
+        count = consume(stream)
+    print "%-20s %8.3fs (%d words)" % (label, time.time() - start, count)
+
+def main(size=64, delay=0.002, chunk=256):
+    fd, path = tempfile.mkstemp(suffix=".txt")
+    try:
+        line = "the quick brown fox jumps over the lazy dog\n"
+        block = line * (1024 * 1024 / len(line))
+        with os.fdopen(fd, "w") as handle:
+            for i in range(size):
+                handle.write(block)
+
+        chunk *= 1024
+        timed("open()", open(path))
+        timed("prefetch", rf.PrefetchFile(io.FileIO(path), chunk))
+
+        SlowFile.delay = delay
+        slow = io.BufferedReader(SlowFile(path), chunk)
+        timed("open() + delay", slow)
+        timed("prefetch + delay", rf.PrefetchFile(SlowFile(path), chunk))
+    finally:
+        os.remove(path)
+
+rf.run(main, Help())
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+#
+# Copyright 2009 Paul J. Davis <paul.joseph.davis@gmail.com>
+#
+# This file is part of the run package released under the BSD license.
+#
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import runfunc as rf
+
+class Help(rf.Help):
+    """\
+    Replay the invocations in a log written by rf.Recorder against the
+    current code and print the parse, call and total latency percentiles of
+    each tool.
+    """
+    log = rf.Path(rf.FILE | rf.EXISTS, "Log written by rf.Recorder.")
+    repeat = rf.Check(int, "Times to run each invocation.", opt='r')
+    path = rf.List("Directory to add to sys.path.", opt='p')
+
+def main(log, repeat=1, path=None):
+    sys.path[:0] = path or []
+    sys.stdout.write(rf.replay(log, repeat=repeat).format())
+
+rf.run(main, Help())
@@ -4,33 +4,103 @@
 # This file is part of the run package released under the BSD license.
 #
 
+import array
+import collections
+import cPickle as pickle
+import csv
+import fnmatch
+import glob
+import hashlib
+import heapq
+import imp
 import inspect
+import io
+import json
+import marshal
+import math
+import mmap
+import multiprocessing
 import os
+import Queue
 import re
+import select
+import stat
+import struct
 import sys
+import tempfile
 import textwrap
+import threading
+import time
+import traceback
 import types
+import zlib
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 from optparse import make_option, IndentedHelpFormatter, \
                 OptionParser, OptionValueError, BadOptionError
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                        use_errno=True)
+    _libc.inotify_init1
+except (ImportError, OSError, AttributeError):
+    _libc = None
+
+__version__ = "0.0.1"
+
 def progname():
     if not sys.argv or not len(sys.argv):
         raise RuntimeError("Empty sys.argv")
     return os.path.basename(sys.argv[0])
 
+def setting(help, name, kind, default=None):
+    """\
+    Read a setting from a Help class. Arguments of the same name are not
+    settings, so they give the default.
+    """
+    value = getattr(help, name, default)
+    return value if isinstance(value, kind) else default
+
 class Arg(object):
+    __slots__ = ("desc", "short", "name", "argname")
+
     def __init__(self, desc, opt=None):
         self.desc = desc
         self.short = opt
         self.name = None
         self.argname = None
     
-    def as_opt(self, default):
+    def opt_strings(self):
         name = self.name.replace('_', '-')
         if self.short:
-            args = ('-%s' % self.short, '--%s' % name)
-        else:
-            args = ('--%s' % name,)
+            return ('-%s' % self.short, '--%s' % name)
+        return ('--%s' % name,)
+
+    def as_opt(self, default):
+        args = self.opt_strings()
         kwargs = {"dest": self.name, "default": default, "help": self.desc}
         ret = self.add_args(kwargs)
         if ret: kwargs = ret
@@ -47,15 +117,30 @@ class Arg(object):
     def do_validate(self, option, optstr, value, parser):
         try:
             self.validate(option, optstr, value, parser)
-        except (BadOptionError, OptionValueError):
+        except (BadOptionError, OptionValueError, PatternError):
             raise
         except Exception, inst:
             raise OptionValueError(str(inst))
 
     def validate(self, option, optstr, value, parser):
         raise NotImplementedError()
+
+    def finalize(self, value):
+        """\
+        Called with the argument's value once every argument is parsed.
+        """
+        return value
+
+    def completion(self):
+        """\
+        Describe how a shell should complete this argument's value. Returns
+        one of "flag", "value", "file", "dir" or "words" and a list of words.
+        """
+        return "value", []
     
 class Check(Arg):
+    __slots__ = ("func",)
+
     def __init__(self, func, desc, opt=None):
         Arg.__init__(self, desc, opt=opt)
         self.func = func
@@ -67,6 +152,8 @@ class Check(Arg):
             raise OptionValueError("Invalid value for %r" % self.name)
     
 class Flag(Arg):
+    __slots__ = ()
+
     def __init__(self, desc, opt=None):
         Arg.__init__(self, desc, opt=opt)
 
@@ -78,17 +165,203 @@ class Flag(Arg):
             "nargs": None
         })
 
+    def completion(self):
+        return "flag", []
+
+def checked(func):
+    """\
+    Wrap `func` to return (True, result) or (False, error message) instead
+    of raising.
+    """
+    def check(value):
+        try:
+            return True, func(value)
+        except Exception, inst:
+            return False, str(inst) or type(inst).__name__
+    return check
+
+# Set before a process pool forks so the workers inherit the validator.
+_CHECK = None
+
+def _check_value(value):
+    return _CHECK(value)
+
+class _Pending(list):
+    """\
+    Values of a List given on the command line that still need validating,
+    and the value they're added to.
+    """
+    def __init__(self, default):
+        list.__init__(self)
+        self.default = default
+
 class List(Arg):
-    def __init__(self, desc, opt=None, validator=None):
+    """\
+    Collect every occurrence of the option into a list. A `validator` is a
+    callable that converts a value or a Path argument that checks it. With
+    `workers` set, values are only collected while parsing and validated
+    together afterwards on a pool of that many threads, or processes if
+    `processes` is true. The order is kept and every failure is reported.
+    Only values from the command line are validated, never the default.
+    """
+    __slots__ = ("validator", "workers", "processes")
+
+    def __init__(self, desc, opt=None, validator=None, workers=None,
+                    processes=False):
         Arg.__init__(self, desc, opt=opt)
+        if isinstance(validator, Path):
+            validator = self.path_check(validator)
         self.validator = validator
+        self.workers = workers
+        self.processes = processes
     
     def validate(self, option, optstr, value, parser):
+        if self.validator and self.workers:
+            # Defaults aren't validated, so keep what came from the command
+            # line apart until finalize.
+            pending = getattr(parser.values, option.dest, None)
+            if not isinstance(pending, _Pending):
+                pending = _Pending(pending)
+                setattr(parser.values, option.dest, pending)
+            pending.append(value)
+            return
         if self.validator:
             value = self.validator(value)
         parser.values.ensure_value(option.dest, []).append(value)
 
+    def finalize(self, value):
+        if not isinstance(value, _Pending):
+            return value
+        results = self.check_all(checked(self.validator), value)
+        errors = ["%s (%s)" % (item, mesg)
+                    for item, (ok, mesg) in zip(value, results) if not ok]
+        if errors:
+            raise OptionValueError("Invalid value%s for %r: %s" % (
+                "s" if len(errors) > 1 else "", self.name, ", ".join(errors)))
+        ret = value.default if value.default is not None else []
+        ret.extend(result for ok, result in results)
+        return ret
+
+    def check_all(self, check, values):
+        global _CHECK
+        workers = min(self.workers, len(values))
+        if workers == 1:
+            return map(check, values)
+        if not self.processes:
+            pool = ThreadPool(workers)
+            try:
+                return pool.map(check, values)
+            finally:
+                pool.terminate()
+        _CHECK = check
+        pool = multiprocessing.Pool(workers)
+        try:
+            return pool.map(_check_value, values)
+        finally:
+            pool.terminate()
+            pool.join()
+            _CHECK = None
+
+    @staticmethod
+    def path_check(path):
+        def check(value):
+            path.check(value)
+            return value
+        return check
+
+class Numbers(Arg):
+    """\
+    Collect numbers into a compact `array.array` instead of a list. Values
+    are separated by commas and integer ranges are written `start-stop` or
+    `start-stop:step`. A value of `@path` reads numbers from a file.
+    """
+    __slots__ = ("typecode", "convert", "min", "max", "ndarray")
+
+    RANGE = re.compile(r"^(-?\d+)-(-?\d+)(?::(\d+))?$")
+    BATCH = 1 << 16
+
+    def __init__(self, desc, opt=None, typecode='l', min=None, max=None,
+                    ndarray=True):
+        Arg.__init__(self, desc, opt=opt)
+        self.typecode = typecode
+        self.convert = float if typecode in "fd" else int
+        self.min = min
+        self.max = max
+        self.ndarray = ndarray
+
+    def validate(self, option, optstr, value, parser):
+        if value.startswith("@"):
+            tokens = self.read(value[1:])
+        else:
+            tokens = value.split(",")
+        arr = array.array(self.typecode)
+        self.extend(parser.values.ensure_value(option.dest, arr), tokens)
+
+    def finalize(self, value):
+        if self.ndarray and numpy is not None \
+                and isinstance(value, array.array):
+            return numpy.frombuffer(value, value.typecode)
+        return value
+
+    def read(self, path):
+        try:
+            with open(path) as handle:
+                for line in handle:
+                    for token in line.replace(",", " ").split():
+                        yield token
+        except (IOError, OSError), inst:
+            mesg = "Unable to read '%s': %s" % (path, inst.strerror)
+            raise OptionValueError(mesg)
+
+    def extend(self, arr, tokens):
+        batch = []
+        for token in tokens:
+            token = token.strip()
+            if not token:
+                continue
+            match = self.convert is int and self.RANGE.match(token)
+            if match:
+                self._store(arr, batch)
+                self._range(arr, token, *match.groups())
+                continue
+            batch.append(token)
+            if len(batch) >= self.BATCH:
+                self._store(arr, batch)
+        self._store(arr, batch)
+
+    def _store(self, arr, batch):
+        if not batch:
+            return
+        try:
+            values = map(self.convert, batch)
+        except ValueError, inst:
+            raise OptionValueError("Invalid number: %s" % inst)
+        self._bounds(min(values), max(values))
+        try:
+            arr.extend(values)
+        except OverflowError:
+            raise OptionValueError("Number too large for %r." % self.name)
+        del batch[:]
+
+    def _range(self, arr, token, start, stop, step):
+        start, stop, step = int(start), int(stop), int(step or 1)
+        if stop < start or step < 1:
+            raise OptionValueError("Invalid range: %r" % token)
+        self._bounds(start, start + (stop - start) // step * step)
+        try:
+            arr.extend(xrange(start, stop + 1, step))
+        except OverflowError:
+            raise OptionValueError("Range too large for %r." % self.name)
+
+    def _bounds(self, low, high):
+        if self.min is not None and low < self.min:
+            raise OptionValueError("%r is less than %r." % (low, self.min))
+        if self.max is not None and high > self.max:
+            raise OptionValueError("%r is greater than %r." % (high, self.max))
+
 class Choice(Arg):
+    __slots__ = ("choices", "validator")
+
     def __init__(self, choices, desc, opt=None, validator=None):
         Arg.__init__(self, desc, opt=opt)
         self.choices = choices
@@ -101,10 +374,80 @@ class Choice(Arg):
             raise OptionValueError("%r is not a valid choice." % value)
         setattr(parser.values, option.dest, value)
 
+    def completion(self):
+        try:
+            return "words", [str(choice) for choice in self.choices]
+        except TypeError:
+            return "value", []
+
+class PatternCache(object):
+    """\
+    Compiled regular expressions shared by every Regexp argument in the
+    process. Once `size` patterns are cached the least recently used one is
+    dropped.
+    """
+    def __init__(self, size=512):
+        self.size = size
+        self.patterns = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def compile(self, source, flags=0):
+        key = (type(source), source, flags)
+        with self.lock:
+            pattern = self.patterns.pop(key, None)
+            if pattern is not None:
+                self.patterns[key] = pattern
+                return pattern
+        pattern = re.compile(source, flags)
+        with self.lock:
+            self.patterns[key] = pattern
+            while len(self.patterns) > self.size:
+                self.patterns.popitem(last=False)
+        return pattern
+
+    def clear(self):
+        with self.lock:
+            self.patterns.clear()
+
+PATTERNS = PatternCache()
+
+class PatternError(re.error):
+    """\
+    The pattern of a Regexp argument doesn't compile. This is a mistake in
+    the Help class rather than in the command line, so it isn't reported as
+    a usage error.
+    """
+
 class Regexp(Arg):
+    """\
+    Require values to match a regular expression. The pattern is compiled
+    through the shared PATTERNS cache the first time a value is checked.
+    """
+    __slots__ = ("source", "flags", "compiled")
+
     def __init__(self, pattern, desc, opt=None, flags=0):
         Arg.__init__(self, desc, opt=opt)
-        self.pattern = re.compile(pattern, flags)
+        self.source = pattern
+        self.flags = flags
+        self.compiled = None
+
+    @property
+    def pattern(self):
+        if self.compiled is None:
+            if isinstance(self.source, basestring):
+                try:
+                    self.compiled = PATTERNS.compile(self.source, self.flags)
+                except re.error, inst:
+                    mesg = "Invalid pattern %r for %s: %s"
+                    raise PatternError(mesg % (self.source, self.name, inst))
+            else:
+                self.compiled = self.source
+        return self.compiled
+
+    @pattern.setter
+    def pattern(self, value):
+        self.source = value
+        self.compiled = None if isinstance(value, basestring) else value
 
     def validate(self, option, optstr, value, parser):
         if not self.pattern.match(value):
@@ -112,20 +455,22 @@ class Regexp(Arg):
         setattr(parser.values, option.dest, value)
 
 class Email(Regexp):
+    __slots__ = ()
+
     def __init__(self, desc, opt=None):
-        Arg.__init__(self, desc, opt=opt)
-        self.pattern = re.compile(
+        Regexp.__init__(self,
             r"\b[A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]{2,4}\b",
-            re.IGNORECASE
+            desc, opt=opt, flags=re.IGNORECASE
         )
 
 class IpAddr(Regexp):
+    __slots__ = ()
+
     def __init__(self, desc, opt=None):
-        Arg.__init__(self, desc, opt=opt)
-        self.pattern = re.compile(r"""
+        Regexp.__init__(self, r"""
             \b(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}
             (?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\b
-        """, re.VERBOSE)
+        """, desc, opt=opt, flags=re.VERBOSE)
 
 FILE   = 1
 DIR    = 2
@@ -133,11 +478,20 @@ EXISTS = 4
 PARENT = 8
 
 class Path(Arg):
+    __slots__ = ("flags",)
+
     def __init__(self, flags, desc, opt=None):
         Arg.__init__(self, desc, opt=opt)
         self.flags = flags
     
     def validate(self, option, optstr, value, parser):
+        self.check(value)
+        setattr(parser.values, option.dest, value)
+
+    def completion(self):
+        return ("dir" if self.flags & DIR else "file"), []
+
+    def check(self, value):
         head, tail = os.path.split(value)
         if self.flags & FILE and not tail:
             raise OptionValueError("File '%s' does not exist." % value)
@@ -149,28 +503,1219 @@ class Path(Arg):
         if self.flags & PARENT and not os.path.exists(head):
             mesg = "Parent directory '%s' does not exist." % head
             raise OptionValueError(mesg)
-        setattr(parser.values, option.dest, value)
+
+def listdir(path, types=True):
+    """\
+    Yield (name, is_dir) pairs for each entry in a directory. The entry
+    type comes from the directory listing itself when scandir is available.
+    Without it, paths are only stat'ed when `types` is true.
+    """
+    path = path or os.curdir
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name, types and entry.is_dir()
+    else:
+        for name in os.listdir(path):
+            yield name, types and os.path.isdir(os.path.join(path, name))
+
+class Matches(object):
+    """\
+    A lazy iterable over the paths matching a list of glob patterns. When
+    `mode` is set each matching file is opened as it's reached.
+    """
+    def __init__(self, flags, mode=None):
+        self.flags = flags
+        self.mode = mode
+        self.patterns = []
+        self.shard = None
+
+    def __iter__(self):
+        for path in self.paths():
+            yield self._result(path)
+
+    def paths(self):
+        """\
+        Iterate over the matching paths without opening them.
+        """
+        if self.shard is None:
+            return self._paths()
+        index, count = self.shard
+        return (p for p in self._paths() if shard_hash(p) % count == index)
+
+    def _paths(self):
+        for pattern in self.patterns:
+            if not glob.has_magic(pattern):
+                yield pattern
+                continue
+            # Entry types are only needed to filter on FILE or DIR. Inner
+            # pattern components always ask for them to find directories.
+            types = bool(self.flags & (FILE | DIR))
+            for path, isdir in self._glob(pattern, types):
+                if self.flags & FILE and isdir:
+                    continue
+                if self.flags & DIR:
+                    if not isdir:
+                        continue
+                    path = os.path.join(path, '')
+                yield path
+
+    def _result(self, path):
+        if self.mode is not None:
+            return open(path, self.mode)
+        return path
+
+    def _glob(self, pattern, types):
+        dirname, basename = os.path.split(pattern)
+        if not glob.has_magic(pattern):
+            if os.path.lexists(pattern):
+                yield pattern, os.path.isdir(pattern)
+            return
+        if glob.has_magic(dirname):
+            dirs = self._glob(dirname, True)
+            dirs = (path for path, isdir in dirs if isdir)
+        else:
+            dirs = [dirname]
+        if not basename:
+            for path in dirs:
+                yield path, True
+            return
+        for path in dirs:
+            try:
+                entries = listdir(path, types)
+                for name, isdir in entries:
+                    if name[0] == '.' and basename[0] != '.':
+                        continue
+                    if fnmatch.fnmatch(name, basename):
+                        yield os.path.join(path, name), isdir
+            except OSError:
+                continue
+
+class Glob(Path):
+    __slots__ = ("mode",)
+
+    def __init__(self, flags, desc, opt=None, mode=None):
+        Path.__init__(self, flags, desc, opt=opt)
+        self.mode = mode
+
+    def validate(self, option, optstr, value, parser):
+        if not glob.has_magic(value):
+            self.check(value)
+        elif self.flags & (EXISTS | PARENT):
+            head = value
+            while glob.has_magic(head):
+                head = os.path.dirname(head)
+            if head and not os.path.isdir(head):
+                raise OptionValueError("Path '%s' does not exist." % head)
+        # The first pattern replaces the function's default.
+        matches = getattr(parser.values, option.dest, None)
+        if not isinstance(matches, Matches):
+            matches = Matches(self.flags, self.mode)
+            setattr(parser.values, option.dest, matches)
+        matches.patterns.append(value)
+
+class AtomicFile(object):
+    """\
+    A write only file that is renamed into place by `commit`. Data goes to
+    a temporary file in the destination's directory so readers never see a
+    partial file. When `threaded` is true, filled buffers are handed to a
+    background thread through a bounded queue so that producing output and
+    writing it to disk overlap.
+    """
+    BUFSIZE = 1 << 20
+    QUEUE = 8
+
+    def __init__(self, name, mode="w", buffering=-1, threaded=False):
+        self.name = name
+        self.mode = mode
+        self.bufsize = buffering if buffering > 0 else self.BUFSIZE
+        self.closed = False
+        self.committed = False
+        dirname, basename = os.path.split(os.path.abspath(name))
+        fd, self.tmpname = tempfile.mkstemp(
+            prefix=".%s." % basename, suffix=".tmp", dir=dirname
+        )
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.tmpname, 0666 & ~umask)
+        if threaded:
+            self.handle = os.fdopen(fd, mode, 0)
+            self.pending = []
+            self.pending_size = 0
+            self.queue = Queue.Queue(self.QUEUE)
+            self.error = None
+            self.writer = threading.Thread(target=self._writer)
+            self.writer.setDaemon(True)
+            self.writer.start()
+        else:
+            self.handle = os.fdopen(fd, mode, self.bufsize)
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def fileno(self):
+        return self.handle.fileno()
+
+    def write(self, data):
+        if self.writer is None:
+            return self.handle.write(data)
+        # Copy like file.write does; callers may reuse their buffer.
+        data = str(data)
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.bufsize:
+            self._handoff()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        """\
+        Write everything buffered so far. In threaded mode this waits for
+        the writer thread so the file is complete up to this point.
+        """
+        if self.writer is not None:
+            self._handoff()
+            self.queue.join()
+            self._check()
+        self.handle.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.writer is not None:
+                self._handoff()
+                self.queue.put(None)
+                self.writer.join()
+                self._check()
+        finally:
+            self.handle.close()
+
+    def commit(self):
+        if not self.closed:
+            self.flush()
+            os.fsync(self.handle.fileno())
+        self.close()
+        os.rename(self.tmpname, self.name)
+        self.committed = True
+
+    def discard(self):
+        try:
+            self.close()
+        finally:
+            if not self.committed and os.path.exists(self.tmpname):
+                os.remove(self.tmpname)
+
+    def _handoff(self):
+        self._check()
+        if not self.pending:
+            return
+        data = ''.join(self.pending)
+        self.pending, self.pending_size = [], 0
+        self.queue.put(data)
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def _writer(self):
+        while True:
+            data = self.queue.get()
+            try:
+                if data is None:
+                    return
+                if self.error is None:
+                    self.handle.write(data)
+            except:
+                self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+class PrefetchFile(object):
+    """\
+    A read only file that reads ahead of its consumer. A background thread
+    fills a fixed ring of reusable buffers from `raw`, which only needs a
+    `readinto` method, while the caller reads lines or chunks from buffers
+    that are already in memory.
+    """
+    CHUNKSIZE = 1 << 20
+    DEPTH = 4
+
+    def __init__(self, raw, chunksize=None, depth=None):
+        self.raw = raw
+        self.name = getattr(raw, "name", None)
+        self.closed = False
+        self.free = Queue.Queue()
+        self.full = Queue.Queue()
+        for i in range(depth or self.DEPTH):
+            self.free.put(bytearray(chunksize or self.CHUNKSIZE))
+        self.chunk = None
+        self.pos = self.end = 0
+        self.eof = False
+        self.reader = threading.Thread(target=self._reader)
+        self.reader.setDaemon(True)
+        self.reader.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __iter__(self):
+        # Split each buffer in one pass instead of searching line by line.
+        partial = ''
+        while self.pos < self.end or self._advance():
+            stop = self.chunk.rfind('\n', self.pos, self.end) + 1
+            if not stop:
+                partial += str(self.chunk[self.pos:self.end])
+                self.pos = self.end
+                continue
+            block = buffer(self.chunk, self.pos, stop - self.pos)
+            for line in StringIO(block):
+                self.pos += len(line)
+                if partial:
+                    line, partial = partial + line, ''
+                yield line
+        if partial:
+            yield partial
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def readinto(self, buf):
+        if self.pos >= self.end and not self._advance():
+            return 0
+        size = min(len(buf), self.end - self.pos)
+        memoryview(buf)[:size] = memoryview(self.chunk)[self.pos:self.pos+size]
+        self.pos += size
+        return size
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.pos >= self.end and not self._advance():
+                break
+            count = self.end - self.pos
+            if size > 0:
+                count = min(count, size)
+                size -= count
+            parts.append(str(self.chunk[self.pos:self.pos+count]))
+            self.pos += count
+        return ''.join(parts)
+
+    def readline(self):
+        parts = []
+        while True:
+            if self.pos >= self.end and not self._advance():
+                break
+            idx = self.chunk.find('\n', self.pos, self.end)
+            stop = self.end if idx < 0 else idx + 1
+            parts.append(str(self.chunk[self.pos:stop]))
+            self.pos = stop
+            if idx >= 0:
+                break
+        return ''.join(parts)
+
+    def readlines(self):
+        return list(self)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.eof = True
+        self.free.put(None)
+        self.reader.join()
+        self.raw.close()
+
+    def _advance(self):
+        if self.chunk is not None:
+            self.free.put(self.chunk)
+            self.chunk = None
+        if self.eof:
+            return False
+        buf, size = self.full.get()
+        if buf is None:
+            self.eof = True
+            raise size[0], size[1], size[2]
+        if not size:
+            self.eof = True
+            self.free.put(buf)
+            return False
+        self.chunk, self.pos, self.end = buf, 0, size
+        return True
+
+    def _reader(self):
+        try:
+            while True:
+                buf = self.free.get()
+                if buf is None or self.closed:
+                    return
+                size = self.raw.readinto(buf)
+                self.full.put((buf, size))
+                if not size:
+                    return
+        except:
+            self.full.put((None, sys.exc_info()))
+
+class Array(Arg):
+    """\
+    Load a file as a NumPy array. `.npy` files and raw binary files are
+    memory mapped, `.csv` files are parsed a block at a time. Every check
+    runs over the whole array at once.
+    """
+    __slots__ = ("dtype", "shape", "min", "max", "finite")
+
+    CHUNKSIZE = 1 << 24
+
+    def __init__(self, desc, opt=None, dtype=float, shape=None, min=None,
+                    max=None, finite=False):
+        Arg.__init__(self, desc, opt=opt)
+        if numpy is None:
+            raise RuntimeError("NumPy is required for Array arguments.")
+        self.dtype = numpy.dtype(dtype)
+        self.shape = shape
+        self.min = min
+        self.max = max
+        self.finite = finite
+
+    def validate(self, option, optstr, value, parser):
+        ext = os.path.splitext(value)[1].lower()
+        try:
+            if ext == ".npy":
+                arr = self.load_npy(value)
+            elif ext == ".csv":
+                arr = self.load_csv(value)
+            else:
+                arr = self.load_raw(value)
+        except (IOError, OSError), inst:
+            raise OptionValueError("Unable to read '%s': %s" % (value, inst))
+        self.check(value, arr)
+        setattr(parser.values, option.dest, arr)
+
+    def completion(self):
+        return "file", []
+
+    def load_npy(self, path):
+        arr = numpy.load(path, mmap_mode="r")
+        if arr.dtype == self.dtype:
+            return arr
+        if not numpy.can_cast(arr.dtype, self.dtype):
+            mesg = "Array '%s' has type %s, expected %s."
+            raise OptionValueError(mesg % (path, arr.dtype, self.dtype))
+        return arr.astype(self.dtype)
+
+    def load_raw(self, path):
+        trailing = tuple(self.shape[1:]) if self.shape else ()
+        if None in trailing:
+            raise OptionValueError("Raw array shapes may only leave the "
+                                        "first dimension unspecified.")
+        row = self.dtype.itemsize * int(numpy.prod(trailing))
+        size = os.path.getsize(path)
+        if size % row:
+            mesg = "Size of '%s' is not a multiple of %d bytes."
+            raise OptionValueError(mesg % (path, row))
+        if not size:
+            return numpy.empty((0,) + trailing, self.dtype)
+        shape = (size // row,) + trailing
+        return numpy.memmap(path, self.dtype, "r", shape=shape)
+
+    def load_csv(self, path):
+        blocks = []
+        columns = None
+        partial = ''
+        with open(path, "rb") as handle:
+            while True:
+                data = handle.read(self.CHUNKSIZE)
+                if not data:
+                    break
+                idx = data.rfind('\n')
+                if idx < 0:
+                    partial += data
+                    continue
+                text, partial = partial + data[:idx+1], data[idx+1:]
+                columns = self._parse_csv(path, text, columns, blocks)
+        if partial.strip():
+            columns = self._parse_csv(path, partial, columns, blocks)
+        if not blocks:
+            return numpy.empty((0, columns or 0), self.dtype)
+        arr = numpy.concatenate(blocks)
+        if self.shape is not None and len(self.shape) == 1:
+            arr = arr.reshape(-1)
+        return arr
+
+    def _parse_csv(self, path, text, columns, blocks):
+        text = text.replace('\r', '').strip()
+        if not text:
+            return columns
+        if columns is None:
+            columns = text.split('\n', 1)[0].count(',') + 1
+        # Count the commas on each line from running totals at the newlines.
+        raw = numpy.frombuffer(text, numpy.uint8)
+        commas = numpy.cumsum(raw == ord(','))
+        ends = commas[raw == ord('\n')]
+        per_line = numpy.diff(numpy.concatenate(([0], ends, commas[-1:])))
+        if (per_line != columns - 1).any():
+            mesg = "Rows in '%s' do not all have %d columns."
+            raise OptionValueError(mesg % (path, columns))
+        text = text.replace('\n', ',')
+        flat = numpy.fromstring(text, self.dtype, sep=',')
+        if flat.size != text.count(',') + 1:
+            raise OptionValueError("Invalid number in '%s'." % path)
+        blocks.append(flat.reshape(-1, columns))
+        return columns
+
+    def check(self, path, arr):
+        if self.shape is not None:
+            match = len(self.shape) == arr.ndim
+            for want, have in zip(self.shape, arr.shape):
+                match = match and want in (None, have)
+            if not match:
+                mesg = "Array '%s' has shape %s, expected %s."
+                raise OptionValueError(mesg % (path, arr.shape, self.shape))
+        if not arr.size:
+            return
+        if self.finite and arr.dtype.kind in "fc":
+            if not numpy.isfinite(arr).all():
+                mesg = "Array '%s' contains values that are not finite."
+                raise OptionValueError(mesg % path)
+        if self.min is not None and arr.min() < self.min:
+            mesg = "Array '%s' has values below %r."
+            raise OptionValueError(mesg % (path, self.min))
+        if self.max is not None and arr.max() > self.max:
+            mesg = "Array '%s' has values above %r."
+            raise OptionValueError(mesg % (path, self.max))
+
+def shard_hash(value):
+    """\
+    A hash of a value's string form that's the same on every machine.
+    """
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    elif not isinstance(value, str):
+        value = str(value)
+    return zlib.crc32(value) & 0xffffffff
+
+class HashedLines(object):
+    """\
+    The lines of a stream whose hash selects the given shard.
+    """
+    def __init__(self, stream, index, count):
+        self.stream = stream
+        self.index = index
+        self.count = count
+        self.name = getattr(stream, "name", None)
+
+    def __iter__(self):
+        index, count = self.index, self.count
+        for line in self.stream:
+            if (zlib.crc32(line) & 0xffffffff) % count == index:
+                yield line
+
+    def read(self):
+        return ''.join(self)
+
+    def close(self):
+        self.stream.close()
+
+class RangeFile(object):
+    """\
+    The lines of a regular file that start inside [start, end). The range
+    is widened to line boundaries so that every line belongs to exactly one
+    range, and only the bytes of this range are read.
+    """
+    BUFSIZE = 1 << 20
+
+    def __init__(self, stream, start, end):
+        self.stream = stream
+        self.name = getattr(stream, "name", None)
+        self.end = end
+        self.pos = start
+        if start > 0:
+            stream.seek(start - 1)
+            if stream.read(1) != '\n':
+                self.pos += len(stream.readline())
+        else:
+            stream.seek(0)
+
+    def __iter__(self):
+        partial = ''
+        while self.pos < self.end:
+            block = self.stream.read(min(self.BUFSIZE, self.end - self.pos))
+            if not block:
+                break
+            self.pos += len(block)
+            if self.pos >= self.end and not block.endswith('\n'):
+                tail = self.stream.readline()
+                self.pos += len(tail)
+                block += tail
+            idx = block.rfind('\n')
+            if idx < 0:
+                partial += block
+                continue
+            lines, partial = StringIO(partial + block[:idx+1]), block[idx+1:]
+            for line in lines:
+                yield line
+        if partial:
+            yield partial
+
+    def readline(self):
+        if self.pos >= self.end:
+            return ''
+        line = self.stream.readline()
+        self.pos += len(line)
+        return line
+
+    def read(self):
+        return ''.join(self)
+
+    def close(self):
+        self.stream.close()
+
+class Shard(Arg):
+    """\
+    Add a `--shard I/N` option that makes run() process only the I'th of N
+    parts of the input. List values, Glob matches and input Streams are
+    split. With mode "hash" items and lines are assigned by a hash of their
+    contents. With mode "range" List values are cut into contiguous slices
+    and regular files into byte ranges aligned to line boundaries, so each
+    shard only reads its own part of the file.
+    """
+    __slots__ = ("mode",)
+
+    def __init__(self, desc="Process only shard I of N, given as I/N.",
+                    opt=None, mode="hash"):
+        Arg.__init__(self, desc, opt=opt)
+        if mode not in ("hash", "range"):
+            raise ValueError("Unknown shard mode: %r" % mode)
+        self.mode = mode
+
+    def validate(self, option, optstr, value, parser):
+        try:
+            index, count = map(int, value.split("/"))
+        except ValueError:
+            raise OptionValueError("Shards are given as I/N: %r" % value)
+        if count < 1 or not 0 <= index < count:
+            raise OptionValueError("Invalid shard: %r" % value)
+        setattr(parser.values, option.dest, (index, count))
+
+    def apply(self, parser, opts, shard):
+        """\
+        Replace each splittable value in `opts` with its part for `shard`.
+        """
+        index, count = shard
+        for name, value in opts.items():
+            arg = parser.args.get(name)
+            if isinstance(value, Matches):
+                value.shard = shard
+            elif isinstance(arg, List) and isinstance(value, list):
+                opts[name] = self.split_list(value, index, count)
+            elif isinstance(arg, Stream) and arg.mode in ("r", "rb") \
+                    and value is not None:
+                opts[name] = self.split_stream(value, index, count)
+
+    def split_list(self, values, index, count):
+        if self.mode == "range":
+            size = len(values)
+            return values[size * index // count:size * (index + 1) // count]
+        return [v for v in values if shard_hash(v) % count == index]
+
+    def split_stream(self, stream, index, count):
+        if self.mode == "range" and isinstance(stream, file):
+            try:
+                size = os.fstat(stream.fileno()).st_size
+                stream.seek(0, os.SEEK_CUR)
+            except (IOError, OSError):
+                pass
+            else:
+                start = size * index // count
+                end = size * (index + 1) // count
+                return RangeFile(stream, start, end)
+        return HashedLines(stream, index, count)
 
 class Stream(Arg):
-    def __init__(self, mode, desc, opt=None):
+    __slots__ = ("mode", "buffering", "atomic", "threaded", "prefetch")
+
+    def __init__(self, mode, desc, opt=None, buffering=-1, atomic=False,
+                    threaded=False, prefetch=False):
         Arg.__init__(self, desc, opt=opt)
+        if atomic and mode not in ("w", "wb"):
+            raise ValueError("Atomic streams must be opened for writing.")
+        if prefetch and mode not in ("r", "rb"):
+            raise ValueError("Prefetched streams must be opened for reading.")
         self.mode = mode
+        self.buffering = buffering
+        self.atomic = atomic
+        self.threaded = threaded
+        self.prefetch = prefetch
+
+    def completion(self):
+        return "file", []
 
     def validate(self, option, optstr, value, parser):
-        setattr(parser.values, option.dest, open(value, self.mode))
+        setattr(parser.values, option.dest, self.open(value))
+
+    def open(self, path):
+        if self.atomic:
+            return AtomicFile(path, self.mode, self.buffering, self.threaded)
+        if self.prefetch:
+            chunksize = self.buffering if self.buffering > 0 else None
+            return PrefetchFile(io.open(path, "rb", 0), chunksize)
+        return open(path, self.mode, self.buffering)
+
+class Handles(object):
+    """\
+    Keep at most `limit` files open. The least recently used file is closed
+    to make room and reopened at the same offset when it's needed again.
+    """
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.open = collections.OrderedDict()
+
+    def get(self, source):
+        handle = self.open.pop(source, None)
+        if handle is None:
+            while len(self.open) >= self.limit:
+                self.open.popitem(last=False)[1].close()
+            handle = open(source.path, "rb")
+            handle.seek(source.offset)
+        self.open[source] = handle
+        return handle
+
+    def release(self, source):
+        handle = self.open.pop(source, None)
+        if handle is not None:
+            handle.close()
+
+    def close(self):
+        while self.open:
+            self.open.popitem()[1].close()
+
+class Source(object):
+    """\
+    One input of a MultiStream. Lines are read `bufsize` bytes at a time so
+    that a file that was closed to free its descriptor is only reopened
+    once per block.
+    """
+    def __init__(self, path, handles, bufsize):
+        self.path = path
+        self.handles = handles
+        self.bufsize = bufsize
+        self.offset = 0
+        self.lines = collections.deque()
+        self.done = False
+
+    def readline(self):
+        if not self.lines and not self.done:
+            handle = self.handles.get(self)
+            self.lines.extend(handle.readlines(self.bufsize))
+            self.offset = handle.tell()
+            if not self.lines:
+                self.done = True
+                self.handles.release(self)
+        return self.lines.popleft() if self.lines else ''
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+class MultiStream(object):
+    """\
+    Iterate over the lines of several files. With order "concat" each file
+    is read in turn, "roundrobin" takes one line from each file in turn and
+    "merge" merges files that are already sorted by `key` in O(n log k).
+    At most `maxopen` files are open at once.
+    """
+    ORDERS = ("concat", "roundrobin", "merge")
+
+    def __init__(self, paths, order="concat", key=None, maxopen=64,
+                    bufsize=1 << 16):
+        if order not in self.ORDERS:
+            raise ValueError("Unknown stream order: %r" % order)
+        self.paths = list(paths)
+        self.order = order
+        self.key = key
+        self.maxopen = maxopen
+        self.bufsize = bufsize
+        self.handles = None
+
+    def __iter__(self):
+        self.close()
+        self.handles = Handles(self.maxopen)
+        sources = [Source(path, self.handles, self.bufsize)
+                    for path in self.paths]
+        try:
+            for line in getattr(self, self.order)(sources):
+                yield line
+        finally:
+            self.close()
+
+    def concat(self, sources):
+        for source in sources:
+            for line in source:
+                yield line
+
+    def roundrobin(self, sources):
+        while sources:
+            active = []
+            for source in sources:
+                line = source.readline()
+                if line:
+                    active.append(source)
+                    yield line
+            sources = active
+
+    def merge(self, sources):
+        key = self.key or (lambda line: line)
+        heap = []
+        for idx, source in enumerate(sources):
+            line = source.readline()
+            if line:
+                heap.append((key(line), idx, line, source))
+        heapq.heapify(heap)
+        while heap:
+            _, idx, line, source = heap[0]
+            yield line
+            line = source.readline()
+            if line:
+                heapq.heapreplace(heap, (key(line), idx, line, source))
+            else:
+                heapq.heappop(heap)
+
+    def close(self):
+        if self.handles is not None:
+            self.handles.close()
+            self.handles = None
+
+class Streams(Arg):
+    """\
+    Collect every occurrence of the option as a path to read and pass the
+    function a MultiStream over all of them.
+    """
+    __slots__ = ("order", "key", "maxopen")
+
+    def __init__(self, desc, opt=None, order="concat", key=None, maxopen=64):
+        Arg.__init__(self, desc, opt=opt)
+        if order not in MultiStream.ORDERS:
+            raise ValueError("Unknown stream order: %r" % order)
+        self.order = order
+        self.key = key
+        self.maxopen = maxopen
+
+    def completion(self):
+        return "file", []
+
+    def validate(self, option, optstr, value, parser):
+        if not os.path.isfile(value) or not os.access(value, os.R_OK):
+            raise OptionValueError("Unable to read '%s'." % value)
+        parser.values.ensure_value(option.dest, []).append(value)
+
+    def finalize(self, value):
+        if not isinstance(value, list):
+            return value
+        return MultiStream(value, self.order, self.key, self.maxopen)
+
+class StatWatcher(object):
+    """\
+    Find changed files by comparing their size and modification time every
+    `interval` seconds.
+    """
+    def __init__(self, interval=0.5):
+        self.interval = interval
+
+    def snapshot(self, paths, ignore=None):
+        ret = {}
+        for path in paths:
+            if os.path.isdir(path):
+                # The names a directory holds, since its own modification
+                # time also changes when ignored files come and go.
+                try:
+                    names = os.listdir(path)
+                except OSError:
+                    names = None
+                if names is not None:
+                    full = os.path.abspath(path)
+                    names = sorted(name for name in names if ignore is None
+                                    or not ignore(os.path.join(full, name)))
+                ret[path] = names
+                continue
+            try:
+                ret[path] = fingerprint(path)
+            except (IOError, OSError):
+                ret[path] = None
+        return ret
+
+    def wait(self, paths, delay, stop, ignore=None):
+        """\
+        Block until some of `paths` change and then until they've been quiet
+        for `delay` seconds. Returns the changed paths, or None once `stop`
+        is set. Files inside watched directories for which `ignore` returns
+        true are left out.
+        """
+        before = self.snapshot(paths, ignore)
+        changed = set()
+        while not stop.is_set():
+            stop.wait(delay if changed else self.interval)
+            after = self.snapshot(paths, ignore)
+            new = set(p for p in paths if after[p] != before[p])
+            if changed and not new:
+                return changed
+            changed |= new
+            before = after
+        return None
+
+    def close(self):
+        pass
+
+class InotifyWatcher(object):
+    """\
+    Find changed files with Linux inotify. The directories holding the
+    files are watched so that files replaced by a rename are noticed too.
+    """
+    MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+    FLAGS = 0o4000 | 0o2000000
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.fd = _libc.inotify_init1(self.FLAGS)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+
+    def watch(self, path):
+        path = os.path.abspath(path) or os.sep
+        if path in self.dirs.values():
+            return
+        wd = _libc.inotify_add_watch(self.fd, path, self.MASK)
+        if wd >= 0:
+            self.dirs[wd] = path
+
+    def events(self):
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except OSError:
+            return
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, size = self.EVENT.unpack_from(data, pos)
+            pos += self.EVENT.size
+            name = data[pos:pos+size].rstrip('\0')
+            pos += size
+            if wd in self.dirs:
+                yield self.dirs[wd], name
+
+    def wait(self, paths, delay, stop, ignore=None):
+        targets = {}
+        for path in paths:
+            full = os.path.abspath(path)
+            targets[full] = path
+            if os.path.isdir(full):
+                self.watch(full)
+            else:
+                self.watch(os.path.dirname(full))
+        changed = set()
+        while not stop.is_set():
+            timeout = delay if changed else self.interval
+            ready = select.select([self.fd], [], [], timeout)[0]
+            if not ready:
+                if changed:
+                    return changed
+                continue
+            for parent, name in self.events():
+                if ignore is not None and name \
+                        and ignore(os.path.join(parent, name)):
+                    continue
+                for full in (os.path.join(parent, name), parent):
+                    if full in targets:
+                        changed.add(targets[full])
+        return None
+
+    def close(self):
+        os.close(self.fd)
+
+def watcher(interval=0.5):
+    """\
+    An inotify watcher where it's available and a stat poller otherwise.
+    """
+    if _libc is not None:
+        try:
+            return InotifyWatcher(interval)
+        except OSError:
+            pass
+    return StatWatcher(interval)
+
+class Watch(Flag):
+    """\
+    Add a `--watch` flag that keeps run() going after the function returns.
+    The function is called again with the same arguments whenever an input
+    file changes, once the changes have been quiet for `delay` seconds.
+    Input streams whose files changed are reopened and others are rewound.
+    Output streams are reopened for every call, and changes to them or to
+    the temporary files of atomic outputs don't start another call.
+    """
+    __slots__ = ("delay", "interval", "stopped")
+
+    def __init__(self, desc="Run again whenever an input changes.", opt=None,
+                    delay=0.1, interval=0.5):
+        Flag.__init__(self, desc, opt=opt)
+        self.delay = delay
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def loop(self, parser, func, help, opts):
+        """\
+        Call the function until stopped or interrupted and return the last
+        result. Exceptions are printed and the watch continues.
+        """
+        self.stopped.clear()
+        files = watcher(self.interval)
+        ret = None
+        try:
+            while True:
+                try:
+                    ret = call_parsed(parser, func, help, opts)
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except Exception:
+                    traceback.print_exc()
+                ignore = self.ignored(parser, opts)
+                paths = set(path for path in self.paths(parser, opts)
+                                if not ignore(os.path.abspath(path)))
+                changed = files.wait(paths, self.delay, self.stopped, ignore)
+                if changed is None:
+                    return ret
+                self.reopen(parser, help, opts, changed)
+        except KeyboardInterrupt:
+            return ret
+        finally:
+            files.close()
+
+    def paths(self, parser, opts):
+        """\
+        The files and directories the arguments in `opts` read from.
+        """
+        ret = set()
+        for name, value in opts.iteritems():
+            arg = parser.args.get(name)
+            if isinstance(value, Changed):
+                value = value.matches
+            if isinstance(value, Matches):
+                ret.update(value.paths())
+                for pattern in value.patterns:
+                    head = os.path.dirname(pattern)
+                    while glob.has_magic(head):
+                        head = os.path.dirname(head)
+                    ret.add(head or os.curdir)
+            elif isinstance(value, MultiStream):
+                ret.update(value.paths)
+            elif isinstance(arg, Stream) and arg.mode in ("r", "rb"):
+                path = getattr(value, "name", None)
+                if isinstance(path, basestring) and os.path.exists(path):
+                    ret.add(path)
+            elif isinstance(arg, Path) and isinstance(value, basestring) \
+                    and os.path.exists(value):
+                ret.add(value)
+        return ret
+
+    def ignored(self, parser, opts):
+        """\
+        A function telling whether an absolute path is one of the outputs
+        in `opts` or the temporary file of an atomic output.
+        """
+        outputs, prefixes = set(), set()
+        for name, value in opts.iteritems():
+            arg = parser.args.get(name)
+            path = getattr(value, "name", None)
+            if isinstance(arg, Stream) and arg.mode not in ("r", "rb") \
+                    and isinstance(path, basestring):
+                dirname, basename = os.path.split(os.path.abspath(path))
+                outputs.add(os.path.join(dirname, basename))
+                prefixes.add(os.path.join(dirname, ".%s." % basename))
+        def ignore(path):
+            if path in outputs:
+                return True
+            return path.endswith(".tmp") and \
+                any(path.startswith(prefix) for prefix in prefixes)
+        return ignore
+
+    def reopen(self, parser, help, opts, changed):
+        reopened = {}
+        for name, value in opts.items():
+            arg = parser.args.get(name)
+            # Rewind or reopen the file under a shard and split it again.
+            if isinstance(value, (HashedLines, RangeFile)):
+                value = value.stream
+            path = getattr(value, "name", None)
+            if not isinstance(arg, Stream) or not isinstance(path, basestring) \
+                    or value in (sys.stdin, sys.stdout, sys.stderr):
+                continue
+            if arg.mode in ("r", "rb") and path not in changed:
+                try:
+                    value.seek(0)
+                    reopened[name] = value
+                    continue
+                except (AttributeError, IOError, ValueError):
+                    pass
+            if not getattr(value, "closed", False):
+                value.close()
+            opts[name] = arg.open(path)
+            if arg.mode in ("r", "rb"):
+                reopened[name] = opts[name]
+        shard = parser.extras.get("shard")
+        if shard is not None:
+            help["shard"].apply(parser, reopened, shard)
+        opts.update(reopened)
+
+def binary(stream):
+    """\
+    Switch one of the standard streams to binary mode. This only matters on
+    platforms that translate line endings.
+    """
+    if sys.platform != "win32":
+        return stream
+    if stream in (sys.stdin, sys.stdout, sys.stderr):
+        import msvcrt
+        msvcrt.setmode(stream.fileno(), os.O_BINARY)
+    return stream
+
+def passthrough(src, dst, bufsize=1 << 16):
+    """\
+    Copy everything left in `src` to `dst` and return the number of bytes
+    copied. The kernel moves the data directly with sendfile when `src` is a
+    regular file with no buffered data. Otherwise a single buffer is reused
+    with `readinto` for the whole copy. `dst` is given views of it, which
+    files and AtomicFile copy as they write them.
+    """
+    binary(src)
+    binary(dst)
+    dst.flush()
+    total = _sendfile(src, dst, bufsize)
+    if total is not None:
+        return total
+
+    total = 0
+    if not hasattr(src, "readinto"):
+        while True:
+            data = src.read(bufsize)
+            if not data:
+                return total
+            dst.write(data)
+            total += len(data)
+
+    buf = bytearray(bufsize)
+    while True:
+        size = src.readinto(buf)
+        if not size:
+            return total
+        dst.write(buffer(buf, 0, size))
+        total += size
+
+def _sendfile(src, dst, bufsize):
+    if sendfile is None or not isinstance(src, (file, io.FileIO)):
+        return None
+    try:
+        infd, outfd = src.fileno(), dst.fileno()
+        # A file object that has read ahead reports a different position
+        # than its descriptor. Copying from the descriptor would skip data.
+        offset = os.lseek(infd, 0, os.SEEK_CUR)
+        if src.tell() != offset:
+            return None
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+    total = 0
+    while True:
+        try:
+            sent = sendfile(outfd, infd, offset + total, bufsize)
+        except OSError:
+            if total:
+                raise
+            return None
+        if not sent:
+            break
+        total += sent
+    os.lseek(infd, offset + total, os.SEEK_SET)
+    return total
+
+class ArgMap(object):
+    """\
+    The arguments of a Help class. Only the arguments a class defines are
+    stored on it. Lookups search the dicts of its bases as well so that
+    large hierarchies of Help classes share their arguments instead of
+    copying them. Later bases take precedence over earlier ones.
+    """
+    __slots__ = ("local", "maps")
+
+    def __init__(self, local, parents=()):
+        self.local = local
+        self.maps = [local]
+        seen = set([id(local)])
+        for parent in reversed(parents):
+            for m in parent.maps:
+                if id(m) not in seen:
+                    seen.add(id(m))
+                    self.maps.append(m)
+
+    def __contains__(self, name):
+        for m in self.maps:
+            if name in m:
+                return True
+        return False
+
+    def __getitem__(self, name):
+        for m in self.maps:
+            if name in m:
+                return m[name]
+        raise KeyError(name)
+
+    def __iter__(self):
+        if len(self.maps) == 1:
+            return iter(self.local)
+        return self._iter()
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    def get(self, name, default=None):
+        for m in self.maps:
+            if name in m:
+                return m[name]
+        return default
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+    def _iter(self):
+        seen = set()
+        for m in self.maps:
+            for name in m:
+                if name not in seen:
+                    seen.add(name)
+                    yield name
 
 class HelpMeta(type):
     def __new__(cls, name, bases, d):
         args = {}
-        for base in bases:
-            if hasattr(base, '_args'):
-                args.update(base._args)
         for attrname, attrval in d.items():
             if isinstance(attrval, Arg):
                 if not attrval.name:
                     attrval.name = attrname
                 args[attrname] = attrval
-        d['_args'] = args
+        parents = [base._args for base in bases if hasattr(base, '_args')]
+        d['_args'] = ArgMap(args, parents)
         return type.__new__(cls, name, bases, d)
 
 class Help(object):
@@ -182,6 +1727,9 @@ class Help(object):
     def __getitem__(self, name):
         return self._args[name]
 
+    def __iter__(self):
+        return iter(self._args)
+
 class Formatter(IndentedHelpFormatter):
     def __init__(self):
         # indent incr, max_help_pos, width, short_first
@@ -200,7 +1748,56 @@ class Formatter(IndentedHelpFormatter):
             opts += " " + (option.metavar or option.dest.upper())
         return opts
 
-class Parser(OptionParser):
+class ArgStream(list):
+    """\
+    A window over an iterable of arguments. Values are pulled from the
+    underlying iterator only as the parser asks for them and any argument
+    that starts with `prefix` is replaced by the lines of that file. Values
+    the parser pulls for an option are never expanded.
+    """
+    def __init__(self, argv, prefix=None):
+        list.__init__(self)
+        self.prefix = prefix
+        self.sources = [iter(argv)]
+
+    def fill(self, count, expand=True):
+        try:
+            while len(self) < count:
+                self.append(self._next(expand))
+        except StopIteration:
+            pass
+        except (IOError, OSError), inst:
+            mesg = "Unable to read response file %r: %s"
+            raise OptionValueError(mesg % (inst.filename, inst.strerror))
+        return len(self) > 0
+
+    def drain(self):
+        self.fill(sys.maxint)
+
+    def _next(self, expand):
+        while self.sources:
+            try:
+                arg = self.sources[-1].next()
+            except StopIteration:
+                self.sources.pop()
+                continue
+            if not expand or not self.prefix \
+                    or not arg.startswith(self.prefix) \
+                    or len(arg) == len(self.prefix):
+                return arg
+            self.sources.append(self._lines(arg[len(self.prefix):]))
+        raise StopIteration()
+
+    def _lines(self, path):
+        with open(path) as handle:
+            for line in handle:
+                yield line.rstrip("\r\n")
+
+# Rendered help pages by the key Parser.help_key() returns.
+_HELP_INDEX = {}
+
+class Parser(OptionParser, object):
+    INTERNAL = (("shard", Shard), ("watch", Watch))
 
     METHOD_TYPES = (
         types.BuiltinMethodType, types.MethodType, types.UnboundMethodType
@@ -211,12 +1808,16 @@ class Parser(OptionParser):
     ) + METHOD_TYPES
 
     def __init__(self, func, help):
+        self._pending = {}
+        self._lazy = {}
+        self._realizing = False
         OptionParser.__init__(self)
         self.formatter = Formatter()
         self.func = func
         self.help = help
         self.usage = getattr(help, "usage", None)
         self.description = help.__doc__
+        self.fromfile_prefix = setting(help, "fromfile_prefix", basestring)
 
         runner = self._runner(func)
         args, varargs, varkw, defaults = inspect.getargspec(runner)
@@ -232,11 +1833,40 @@ class Parser(OptionParser):
             raise RuntimeError("Unknown argument: %r" % arg)
 
         self.required = args[:len(args)-len(defaults)]
-        for name, value in zip(args[len(args)-len(defaults):], defaults):
-            opt = help[name].as_opt(value)
-            self.add_option(opt)
-        
+        self.optional = args[len(args)-len(defaults):]
+        defaults = zip(self.optional, defaults)
+
+        # Functions taking **kwargs can accept every argument on the Help.
+        if varkw and setting(help, "all_options", bool, False):
+            known = set(args)
+            extra = [name for name in help if name not in known]
+            self.optional = self.optional + extra
+            defaults.extend((name, None) for name in extra)
+
+        # Options run() handles itself instead of passing to the function.
+        self.internal = []
+        self.extras = {}
+        for name, kind in self.INTERNAL:
+            if name not in help or not isinstance(help[name], kind) \
+                    or name in args:
+                continue
+            if name not in self.optional:
+                self.optional = self.optional + [name]
+                defaults.append((name, None))
+            self.internal.append(name)
+
+        self.args = dict((name, help[name]) for name in self.required)
+        self.args.update((name, help[name]) for name in self.optional)
+        self.finalizers = [name for name, arg in self.args.iteritems()
+                            if type(arg).finalize != Arg.finalize]
+
+        # Options are only built when they're used on the command line or
+        # the whole list is needed, such as for printing help.
+        for name, value in defaults:
+            self._defer(name, value)
+
     def parse(self, argv):
+        argv = ArgStream(argv, self.fromfile_prefix)
         opts, args = OptionParser.parse_args(self, argv)
 
         if len(args) < len(self.required):
@@ -256,8 +1886,295 @@ class Parser(OptionParser):
             except (BadOptionError, OptionValueError), inst:
                 self.error(str(inst))
 
+        for name in self.finalizers:
+            try:
+                value = self.args[name].finalize(getattr(opts, name))
+            except (BadOptionError, OptionValueError), inst:
+                self.error(str(inst))
+            setattr(opts, name, value)
+
+        for name in self.internal:
+            self.extras[name] = opts.__dict__.pop(name, None)
+
         return opts.__dict__
 
+    def finish(self, success):
+        """\
+        Commit or discard any atomic output streams created while parsing.
+        """
+        if self.values is None:
+            return
+        for value in self.values.__dict__.itervalues():
+            if not isinstance(value, AtomicFile):
+                continue
+            if success:
+                value.commit()
+            else:
+                value.discard()
+
+    def completion_index(self):
+        """\
+        Render the table a shell uses to complete this parser's arguments.
+        Each line holds the option strings, the kind of value and any words
+        to offer, separated by tabs. Positional arguments have no option
+        strings and are listed in order.
+        """
+        lines = [INDEX_HEADER, "-h --help\tflag\t"]
+        for name in self.optional:
+            arg = self.args[name]
+            kind, words = arg.completion()
+            opts = ' '.join(arg.opt_strings())
+            lines.append("%s\t%s\t%s" % (opts, kind, ' '.join(words)))
+        for name in self.required:
+            kind, words = self.args[name].completion()
+            lines.append("\t%s\t%s" % (kind, ' '.join(words)))
+        return '\n'.join(lines) + '\n'
+
+    def format_help(self, formatter=None):
+        if formatter is not None:
+            return OptionParser.format_help(self, formatter)
+        return self.help_index()["page"]
+
+    def print_matching_help(self, pattern, file=None):
+        """\
+        Print the help of the options whose names match `pattern`, or whose
+        names or descriptions contain it when it has no wildcards.
+        """
+        if file is None:
+            file = sys.stdout
+        blocks = self.matching_help(pattern)
+        if blocks:
+            text = "Options matching %r:\n%s" % (pattern, ''.join(blocks))
+        else:
+            text = "No options match %r.\n" % pattern
+        encoding = getattr(file, "encoding", None) or sys.getdefaultencoding()
+        if isinstance(text, unicode):
+            text = text.encode(encoding, "replace")
+        file.write(text)
+
+    def matching_help(self, pattern):
+        index = self.help_index()
+        options, names = index["options"], index["names"]
+        for name in (pattern, "--" + pattern, "-" + pattern):
+            if name in names:
+                return [options[names[name]][1]]
+        if glob.has_magic(pattern):
+            match = lambda opts, block: any(fnmatch.fnmatchcase(name, pattern)
+                                                for name in opts)
+        else:
+            lowered = pattern.lower()
+            match = lambda opts, block: lowered in block.lower()
+        return [block for opts, block in options if match(opts, block)]
+
+    def help_index(self):
+        """\
+        Return the rendered help page and the help of each option. They're
+        rendered once for each set of options, program name and terminal
+        width and kept in memory and in the Help class's `help_cache`
+        directory, which defaults to the user's cache directory.
+        """
+        key = self.help_key()
+        index = _HELP_INDEX.get(key)
+        if index is not None:
+            return index
+        path = self.help_path(key)
+        if path is not None:
+            try:
+                with open(path) as handle:
+                    index = json.load(handle)
+            except (IOError, OSError, ValueError):
+                index = None
+        if index is None or index.get("version") != 1:
+            index = self.render_help()
+            if path is not None:
+                self.save_help(path, index)
+        index["names"] = dict((name, idx) for idx, (opts, block)
+                                in enumerate(index["options"])
+                                for name in opts)
+        if len(_HELP_INDEX) >= 64:
+            _HELP_INDEX.clear()
+        _HELP_INDEX[key] = index
+        return index
+
+    def help_key(self):
+        formatter = self.formatter.__class__
+        parts = [__version__, formatter.__module__, formatter.__name__,
+                    self.get_prog_name(), self.formatter.width, self.usage,
+                    self.description, self.required]
+        for name in self.optional:
+            arg = self.args[name]
+            default = None
+            if "%default" in (arg.desc or ""):
+                default = repr(self.defaults.get(arg.name))
+            parts.append((name, type(arg).__name__, arg.desc,
+                            arg.opt_strings(), default))
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def help_path(self, key):
+        dirname = setting(self.help, "help_cache",
+                            (bool, basestring, types.NoneType), True)
+        if not dirname:
+            return None
+        if dirname is True:
+            dirname = os.path.join(cache_dir(), "help")
+        return os.path.join(os.path.expanduser(dirname), "%s.json" % key)
+
+    def render_help(self):
+        page = OptionParser.format_help(self)
+        formatter = self.formatter
+        formatter.store_option_strings(self)
+        formatter.indent()
+        options = []
+        for option in self.option_list:
+            opts = option._short_opts + option._long_opts
+            options.append([opts, formatter.format_option(option)])
+        formatter.dedent()
+        return {"version": 1, "page": page, "options": options}
+
+    def save_help(self, path, index):
+        try:
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            stream = AtomicFile(path)
+            try:
+                json.dump(index, stream)
+            except:
+                stream.discard()
+                raise
+            stream.commit()
+        except (IOError, OSError):
+            pass
+
+    def get_option(self, opt_str):
+        self._realize(self._lazy.get(opt_str))
+        return OptionParser.get_option(self, opt_str)
+
+    def has_option(self, opt_str):
+        return opt_str in self._lazy or OptionParser.has_option(self, opt_str)
+
+    def get_default_values(self):
+        # Only options that exist need their defaults checked. Deferred
+        # options are added as they're seen during parsing.
+        pending, self._pending = self._pending, {}
+        try:
+            return OptionParser.get_default_values(self)
+        finally:
+            self._pending = pending
+
+    def _get_option_list(self):
+        if self._pending and not self._realizing:
+            for name in self.optional:
+                self._realize(name)
+            order = dict((name, idx) for idx, name in enumerate(self.optional))
+            self._option_list.sort(key=lambda o: order.get(o.dest, -1))
+        return self._option_list
+
+    def _set_option_list(self, value):
+        self._option_list = value
+
+    option_list = property(_get_option_list, _set_option_list)
+
+    def _defer(self, name, default):
+        arg = self.args[name]
+        self.defaults[arg.name] = default
+        self._pending[name] = default
+        for opt_str in arg.opt_strings():
+            # Let optparse report conflicts while the parser is built.
+            if opt_str in self._short_opt or opt_str in self._long_opt:
+                self._realize(name)
+                return
+            if opt_str in self._lazy:
+                self._realize(self._lazy[opt_str])
+                self._realize(name)
+                return
+            self._lazy[opt_str] = name
+
+    def _realize(self, name):
+        if name not in self._pending:
+            return
+        arg = self.args[name]
+        default = self._pending.pop(name)
+        for opt_str in arg.opt_strings():
+            if self._lazy.get(opt_str) == name:
+                del self._lazy[opt_str]
+        self._realizing = True
+        try:
+            self.add_option(arg.as_opt(default))
+        finally:
+            self._realizing = False
+
+    def _match_long_opt(self, opt):
+        if opt in self._lazy:
+            self._realize(self._lazy[opt])
+        elif opt not in self._long_opt:
+            # Realize every option an abbreviation could refer to.
+            for opt_str, name in self._lazy.items():
+                if opt_str.startswith(opt):
+                    self._realize(name)
+        return OptionParser._match_long_opt(self, opt)
+
+    def _process_short_opts(self, rargs, values):
+        self._nargs(rargs[0])
+        return OptionParser._process_short_opts(self, rargs, values)
+
+    def _nargs(self, arg):
+        """\
+        Make sure the options in `arg` exist and return how many values
+        they consume from the arguments that follow it.
+        """
+        if arg[0:2] == "--":
+            try:
+                opt = self._match_long_opt(arg.split("=", 1)[0])
+            except BadOptionError:
+                return 0
+            return 0 if "=" in arg else (self._long_opt[opt].nargs or 0)
+        for idx, ch in enumerate(arg[1:]):
+            self._realize(self._lazy.get("-" + ch))
+            option = self._short_opt.get("-" + ch)
+            if option is not None and option.takes_value():
+                return 0 if arg[idx+2:] else (option.nargs or 0)
+        return 0
+
+    def _get_args(self, args):
+        if isinstance(args, ArgStream):
+            return args
+        return OptionParser._get_args(self, args)
+
+    def _process_args(self, largs, rargs, values):
+        if not isinstance(rargs, ArgStream):
+            return OptionParser._process_args(self, largs, rargs, values)
+
+        # An option and its values are the most we ever need to look at
+        # before consuming them.
+        while rargs.fill(1):
+            arg = rargs[0]
+            if arg == "--":
+                del rargs[0]
+                break
+            elif arg[:7] == "--help=":
+                self.print_matching_help(arg[7:])
+                self.exit()
+            elif arg[0:2] == "--":
+                rargs.fill(1 + self._nargs(arg), expand=False)
+                self._process_long_opt(rargs, values)
+            elif arg[:1] == "-" and len(arg) > 1:
+                rargs.fill(1 + self._nargs(arg), expand=False)
+                self._process_short_opts(rargs, values)
+            elif self.allow_interspersed_args:
+                if len(largs) >= len(self.required):
+                    self.error("Unexpected argument: %s" % arg)
+                largs.append(arg)
+                del rargs[0]
+            else:
+                break
+
+        # Whatever is left can only be positional arguments.
+        if rargs.fill(len(self.required) - len(largs) + 1):
+            if len(largs) + len(rargs) > len(self.required):
+                extra = rargs[len(self.required) - len(largs)]
+                self.error("Unexpected argument: %s" % extra)
+
     def _runner(self, func):
         runner = func
         if isinstance(runner, (types.ClassType, types.TypeType)):
@@ -274,6 +2191,626 @@ class Parser(OptionParser):
 
         return runner
 
+INDEX_HEADER = "# runfunc completion index 1"
+
+# Answers a completion request from the index alone. It runs with -S so
+# that neither site packages nor the user's script are imported. It has no
+# quotes or backslashes so it can be embedded in any shell's single quotes.
+COMPLETER = """
+import sys
+index, cword = sys.argv[1], int(sys.argv[2])
+words = sys.argv[3:cword+4]
+opts, pos = {}, []
+for line in open(index).read().splitlines()[1:]:
+    names, kind, choices = line.split(chr(9))
+    for name in names.split():
+        opts[name] = (kind, choices.split())
+    if not names:
+        pos.append((kind, choices.split()))
+merged, split = [], False
+for word in words:
+    last = merged[-1] if merged else ""
+    if last[:2] == "--" and (word == "=" or last[-1:] == "="):
+        merged[-1] += word
+        split = True
+    else:
+        merged.append(word)
+        split = False
+cur, before = merged[-1] if len(merged) >= 2 else "", merged[1:-1]
+expect, npos, ended = None, 0, False
+for word in before:
+    if expect is not None:
+        expect = None
+    elif word == "--" and not ended:
+        ended = True
+    elif word[:1] == "-" and len(word) > 1 and not ended:
+        entry = opts.get(word)
+        if entry is not None and entry[0] != "flag":
+            expect = entry
+    else:
+        npos += 1
+lead = ""
+if expect is None and cur[:2] == "--" and "=" in cur:
+    name, cur = cur.split("=", 1)
+    expect = opts.get(name, ("value", []))
+    lead = "" if split else name + "="
+elif expect is None and cur[:1] == "-" and not ended:
+    expect = ("words", sorted(opts))
+elif expect is None:
+    expect = pos[npos] if npos < len(pos) else ("file", [])
+kind, choices = expect
+out = [kind, ":" + cur, ":" + lead]
+if kind == "words":
+    out.extend(lead + c for c in choices if c.startswith(cur))
+sys.stdout.write(chr(10).join(out) + chr(10))
+"""
+
+SCRIPTS = {
+    "bash": """\
+_runfunc_%(func)s() {
+    local IFS=$'\\n'
+    local out
+    out=($(%(python)s -S -c '%(completer)s' '%(index)s' "$COMP_CWORD" \\
+            "${COMP_WORDS[@]}" 2>/dev/null))
+    case "${out[0]}" in
+        file) COMPREPLY=($(compgen -f -- "${out[1]#:}")) ;;
+        dir) COMPREPLY=($(compgen -d -- "${out[1]#:}")) ;;
+        words) COMPREPLY=("${out[@]:3}") ;;
+        *) COMPREPLY=() ;;
+    esac
+}
+complete -o filenames -F _runfunc_%(func)s %(prog)s
+""",
+    "zsh": """\
+_runfunc_%(func)s() {
+    local -a out
+    out=("${(@f)$(%(python)s -S -c '%(completer)s' '%(index)s' \\
+            $((CURRENT - 1)) "${words[@]}" 2>/dev/null)}")
+    local lead=${out[3]#:}
+    [[ -n $lead ]] && compset -P '*='
+    case $out[1] in
+        file) _files ;;
+        dir) _files -/ ;;
+        words) compadd -Q -- "${(@)out[4,-1]#$lead}" ;;
+    esac
+}
+compdef _runfunc_%(func)s %(prog)s
+""",
+    "fish": """\
+function __runfunc_%(func)s
+    set -l tokens (commandline -opc) (commandline -ct)
+    set -l out (%(python)s -S -c '%(completer)s' '%(index)s' \\
+            (math (count $tokens) - 1) $tokens 2>/dev/null)
+    set -l cur (string sub -s 2 -- $out[2])
+    set -l lead (string sub -s 2 -- $out[3])
+    switch "$out[1]"
+        case file
+            for path in (__fish_complete_path "$cur")
+                echo "$lead$path"
+            end
+        case dir
+            for path in (__fish_complete_directories "$cur")
+                echo "$lead$path"
+            end
+        case words
+            printf '%%s\\n' $out[4..-1]
+    end
+end
+complete -c %(prog)s -f -a '(__runfunc_%(func)s)'
+""",
+}
+
+def index_path(script):
+    """\
+    Find where the completion index for `script` is kept. It's stored next
+    to the script when that directory is writable and in the user's cache
+    directory otherwise.
+    """
+    script = os.path.abspath(script)
+    dirname, basename = os.path.split(script)
+    local = os.path.join(dirname, ".%s.complete" % basename)
+    if os.path.exists(local) or os.access(dirname, os.W_OK):
+        return local
+    digest = hashlib.sha1(script).hexdigest()
+    return os.path.join(cache_dir(), "%s.complete" % digest)
+
+def cache_dir():
+    """\
+    The directory for files runfunc keeps in the user's cache directory.
+    """
+    cache = os.environ.get("XDG_CACHE_HOME") or \
+                os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache, "runfunc")
+
+def update_index(parser, path):
+    """\
+    Write the parser's completion index to `path` unless it's unchanged.
+    Returns true if the file was written.
+    """
+    index = parser.completion_index()
+    try:
+        with open(path) as handle:
+            if handle.read() == index:
+                return False
+    except IOError:
+        pass
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    stream = AtomicFile(path)
+    try:
+        stream.write(index)
+    except:
+        stream.discard()
+        raise
+    stream.commit()
+    return True
+
+def completion_script(parser, shell, script):
+    """\
+    Write the completion index for `script` and return the code that
+    registers its completion function with `shell`.
+    """
+    if shell not in SCRIPTS:
+        raise ValueError("Unsupported shell: %r" % shell)
+    path = index_path(script)
+    update_index(parser, path)
+    prog = os.path.basename(script)
+    return SCRIPTS[shell] % {
+        "func": re.sub(r"\W", "_", prog),
+        "prog": prog,
+        "python": sys.executable,
+        "index": path,
+        "completer": COMPLETER.strip()
+    }
+
+def fingerprint(path, contents=False):
+    """\
+    Return a tuple of a file's size and modification time, followed by a
+    hex digest of its contents when `contents` is true.
+    """
+    st = os.stat(path)
+    if not contents or not os.path.isfile(path):
+        return (st.st_size, st.st_mtime)
+    digest = hashlib.sha1()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), ''):
+            digest.update(block)
+    return (st.st_size, st.st_mtime, digest.hexdigest())
+
+def format_lines(items):
+    parts = []
+    for item in items:
+        if isinstance(item, unicode):
+            item = item.encode("utf-8")
+        elif not isinstance(item, str):
+            item = str(item)
+        parts.append(item)
+    parts.append('')
+    return '\n'.join(parts)
+
+def format_jsonl(items):
+    return ''.join([json.dumps(item) + '\n' for item in items])
+
+def format_csv(items):
+    out = StringIO()
+    csv.writer(out).writerows(items)
+    return out.getvalue()
+
+FORMATS = {
+    "lines": format_lines,
+    "jsonl": format_jsonl,
+    "csv": format_csv
+}
+
+class Output(object):
+    """\
+    Write the items of an iterator returned by the function. Items are
+    serialized a batch at a time by a callable that takes a list of items
+    and returns a string, or by one of the named FORMATS. Serialized data
+    is collected until there's at least `bufsize` bytes before it's
+    written. Output goes to the Stream argument named `dest` or to
+    standard output.
+    """
+    def __init__(self, format="lines", dest=None, bufsize=1 << 16,
+                    batch=1024):
+        if not callable(format) and format not in FORMATS:
+            raise ValueError("Unknown output format: %r" % format)
+        self.format = FORMATS.get(format, format)
+        self.dest = dest
+        self.bufsize = bufsize
+        self.batch = batch
+
+    def emit(self, items, opts):
+        """\
+        Write every item and return how many were written.
+        """
+        stream = opts.get(self.dest) if self.dest else None
+        if stream is None:
+            stream = sys.stdout
+        count, size, pending, chunks = 0, 0, [], []
+        for item in items:
+            pending.append(item)
+            if len(pending) < self.batch:
+                continue
+            count += len(pending)
+            data = self.format(pending)
+            pending = []
+            chunks.append(data)
+            size += len(data)
+            if size >= self.bufsize:
+                stream.write(''.join(chunks))
+                size, chunks = 0, []
+        if pending:
+            count += len(pending)
+            chunks.append(self.format(pending))
+        if chunks:
+            stream.write(''.join(chunks))
+        stream.flush()
+        return count
+
+class MappedRange(object):
+    """\
+    The lines of a memory mapped file that start inside [start, end). The
+    bounds are moved to line boundaries the same way as RangeFile. Lines
+    are sliced out of the mapping as they're read and `view()` returns the
+    whole range without copying it.
+    """
+    def __init__(self, data, start, end, name=None):
+        size = len(data)
+        if start > 0 and data[start-1] != '\n':
+            start = self.boundary(data, start)
+        if end < size and data[end-1] != '\n':
+            end = self.boundary(data, end)
+        self.data = data
+        self.start = self.pos = start
+        self.end = max(start, end)
+        self.name = name
+
+    def boundary(self, data, pos):
+        idx = data.find('\n', pos)
+        return len(data) if idx < 0 else idx + 1
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def readline(self):
+        if self.pos >= self.end:
+            return ''
+        idx = self.data.find('\n', self.pos, self.end)
+        stop = self.end if idx < 0 else idx + 1
+        line = self.data[self.pos:stop]
+        self.pos = stop
+        return line
+
+    def read(self, size=-1):
+        stop = self.end if size < 0 else min(self.end, self.pos + size)
+        data = self.data[self.pos:stop]
+        self.pos = stop
+        return data
+
+    def view(self):
+        return buffer(self.data, self.start, self.end - self.start)
+
+    def close(self):
+        pass
+
+# Set before the pool forks so the workers inherit the function, its
+# arguments and the mapping without pickling them.
+_MAPREDUCE = None
+
+def _map_range(bounds):
+    func, opts, name, data, path = _MAPREDUCE
+    opts = dict(opts)
+    opts[name] = MappedRange(data, bounds[0], bounds[1], path)
+    return func(**opts)
+
+class MapReduce(object):
+    """\
+    Run the function over newline aligned byte ranges of the regular file
+    opened by the Stream argument named `stream`, in a pool of `workers`
+    processes, and combine the results in file order with `reduce(a, b)`.
+    The file is memory mapped once before the pool forks. Each call gets a
+    MappedRange in place of the stream. Inputs that aren't regular files
+    are passed to a single call as is.
+    """
+    def __init__(self, stream, reduce, workers=None, chunksize=1 << 26):
+        self.stream = stream
+        self.reduce = reduce
+        self.workers = workers
+        self.chunksize = chunksize
+
+    def ranges(self, size, workers):
+        count = max(workers, -(-size // self.chunksize))
+        bounds = [size * i // count for i in range(count + 1)]
+        return zip(bounds, bounds[1:])
+
+    def call(self, func, opts):
+        global _MAPREDUCE
+        handle = opts.get(self.stream)
+        try:
+            info = os.fstat(handle.fileno())
+        except (AttributeError, IOError, OSError, ValueError):
+            return func(**opts)
+        if not stat.S_ISREG(info.st_mode) or not info.st_size:
+            return func(**opts)
+        workers = self.workers or multiprocessing.cpu_count()
+        data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        name = getattr(handle, "name", None)
+        _MAPREDUCE = (func, opts, self.stream, data, name)
+        pool = None
+        try:
+            ranges = self.ranges(info.st_size, workers)
+            if workers == 1:
+                results = (_map_range(bounds) for bounds in ranges)
+            else:
+                pool = multiprocessing.Pool(workers)
+                results = pool.imap(_map_range, ranges)
+            ret = results.next()
+            for result in results:
+                ret = self.reduce(ret, result)
+            return ret
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            _MAPREDUCE = None
+            data.close()
+
+class Uncacheable(Exception):
+    pass
+
+class Tee(object):
+    """\
+    Pass writes through to a stream while keeping a copy of them.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.copy = StringIO()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def write(self, data):
+        self.stream.write(data)
+        self.copy.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def getvalue(self):
+        return self.copy.getvalue()
+
+class Cache(object):
+    """\
+    Remember the results of whole invocations. Entries are keyed on the
+    function's name and code, its arguments, and the size and modification
+    time of every input file, or its contents when `contents` is true. A
+    hit replays the function's standard output, rewrites its output streams
+    and returns the saved return value without calling it.
+
+    Entries are written with atomic renames so concurrent processes can
+    share a cache directory. The least recently used entries are removed
+    once the cache grows past `limit` bytes.
+    """
+    def __init__(self, path, limit=1 << 28, contents=False):
+        self.path = os.path.expanduser(path)
+        self.limit = limit
+        self.contents = contents
+
+    def key(self, parser, func, opts):
+        """\
+        Return the key for calling `func` with `opts`, or None if the call
+        can't be cached.
+        """
+        runner = parser._runner(func)
+        code = getattr(getattr(runner, "im_func", runner), "func_code", None)
+        parts = [
+            getattr(func, "__module__", None),
+            getattr(func, "__name__", type(func).__name__),
+            marshal.dumps(code) if code is not None else None,
+            sorted(parser.extras.items())
+        ]
+        try:
+            for name in sorted(opts):
+                value = self.fingerprint(parser.args.get(name), opts[name])
+                parts.append((name, value))
+            data = pickle.dumps(parts, 2)
+        except (Uncacheable, pickle.PicklingError, TypeError):
+            return None
+        return hashlib.sha1(data).hexdigest()
+
+    def fingerprint(self, arg, value):
+        if isinstance(value, (HashedLines, RangeFile)):
+            value = value.stream
+        if isinstance(arg, Stream) and isinstance(value, (file, AtomicFile,
+                                                            PrefetchFile)):
+            if value in (sys.stdin, sys.stdout, sys.stderr):
+                if value is not sys.stdout:
+                    raise Uncacheable()
+                return "<stdout>"
+            if arg.mode in ("w", "wb"):
+                return ("output", value.name)
+            if arg.mode not in ("r", "rb"):
+                raise Uncacheable()
+            return self.stat(value.name)
+        if isinstance(value, Matches):
+            return [self.stat(path) for path in value.paths()]
+        if isinstance(value, MultiStream):
+            return [self.stat(path) for path in value.paths]
+        if isinstance(arg, Path) and isinstance(value, basestring):
+            return self.stat(value) if os.path.exists(value) else value
+        if numpy is not None and isinstance(value, numpy.ndarray):
+            data = numpy.ascontiguousarray(value)
+            return (value.dtype.str, value.shape, hashlib.sha1(data).digest())
+        if isinstance(value, array.array):
+            return (value.typecode, hashlib.sha1(value).digest())
+        if isinstance(value, (file, io.IOBase)):
+            raise Uncacheable()
+        return value
+
+    def stat(self, path):
+        try:
+            return (os.path.abspath(path),) + fingerprint(path, self.contents)
+        except (IOError, OSError):
+            raise Uncacheable()
+
+    def load(self, key):
+        path = os.path.join(self.path, key)
+        try:
+            with open(path, "rb") as handle:
+                entry = pickle.load(handle)
+            os.utime(path, None)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return entry
+
+    def call(self, func, opts):
+        """\
+        Call `func` while copying everything it writes to standard output.
+        Returns its return value and the output.
+        """
+        stdout, tee = sys.stdout, Tee(sys.stdout)
+        opts = dict(opts)
+        for name, value in opts.items():
+            if value is stdout:
+                opts[name] = tee
+        sys.stdout = tee
+        try:
+            ret = func(**opts)
+        finally:
+            sys.stdout = stdout
+        return ret, tee.getvalue()
+
+    def replay(self, entry, opts):
+        sys.stdout.write(entry["stdout"])
+        for name, data in entry["outputs"].iteritems():
+            opts[name].write(data)
+            opts[name].flush()
+        return entry["value"]
+
+    def save(self, key, value, stdout, parser, opts):
+        outputs = {}
+        for name, stream in opts.iteritems():
+            arg = parser.args.get(name)
+            if not isinstance(arg, Stream) or arg.mode not in ("w", "wb"):
+                continue
+            if isinstance(stream, (file, AtomicFile)) \
+                    and stream is not sys.stdout:
+                # The function's data may still be buffered in the stream.
+                if not stream.closed:
+                    stream.flush()
+                with open(stream.name, "rb") as handle:
+                    outputs[name] = handle.read()
+        entry = {"value": value, "stdout": stdout, "outputs": outputs}
+        try:
+            data = pickle.dumps(entry, 2)
+        except (pickle.PicklingError, TypeError):
+            return
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+        stream = AtomicFile(os.path.join(self.path, key), "wb")
+        try:
+            stream.write(data)
+        except:
+            stream.discard()
+            raise
+        stream.commit()
+        self.evict()
+
+    def evict(self):
+        entries, total = [], 0
+        for name in os.listdir(self.path):
+            if name.startswith("."):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        entries.sort()
+        while total > self.limit and entries:
+            mtime, size, name = entries.pop(0)
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+class Changed(object):
+    """\
+    The matches of a Glob argument that are new or have changed since the
+    last successful run. Each match is recorded as it's handed out.
+    """
+    def __init__(self, checkpoint, name, matches):
+        self.checkpoint = checkpoint
+        self.name = name
+        self.matches = matches
+
+    def __iter__(self):
+        done = self.checkpoint.state.get(self.name, {})
+        seen = self.checkpoint.seen.setdefault(self.name, {})
+        for path in self.matches.paths():
+            key = os.path.abspath(path)
+            try:
+                current = list(fingerprint(path, self.checkpoint.contents))
+            except (IOError, OSError):
+                current = None
+            if current is not None and done.get(key) == current:
+                continue
+            if current is not None:
+                seen[key] = current
+            yield self.matches._result(path)
+
+class Checkpoint(object):
+    """\
+    Remember which inputs of Glob arguments were processed so that later
+    runs only see files that are new or have changed. The state file is
+    replaced atomically after the function returns successfully.
+    """
+    def __init__(self, path, contents=False):
+        self.path = os.path.expanduser(path)
+        self.contents = contents
+        self.state = {}
+        self.seen = {}
+
+    def filter(self, parser, opts):
+        self.state = self.load()
+        self.seen = {}
+        for name, value in opts.items():
+            if isinstance(value, Matches):
+                opts[name] = Changed(self, name, value)
+
+    def load(self):
+        try:
+            with open(self.path) as handle:
+                state = json.load(handle)
+        except IOError:
+            return {}
+        except ValueError:
+            raise RuntimeError("Invalid checkpoint file: %r" % self.path)
+        return state.get("inputs", {})
+
+    def commit(self):
+        if not self.seen:
+            return
+        for name, seen in self.seen.iteritems():
+            self.state.setdefault(name, {}).update(seen)
+        stream = AtomicFile(self.path)
+        try:
+            json.dump({"version": 1, "inputs": self.state}, stream)
+        except:
+            stream.discard()
+            raise
+        stream.commit()
+        self.seen = {}
+
 def is_main():
     stack = inspect.stack()
     if len(stack) < 2: return True
@@ -285,11 +2822,449 @@ def run(func, help, argv=None, check=True):
     if check and not is_main():
         return # Don't run when imported.
 
+    script = None
     if argv is None:
-        argv = sys.argv[1:]
-    if not isinstance(argv, list):
+        script, argv = sys.argv[0], sys.argv[1:]
+    if isinstance(argv, basestring) or not hasattr(argv, "__iter__"):
         raise TypeError("Invalid argument list: %r" % argv)
 
     parser = Parser(func, help)
-    opts = parser.parse(argv)
-    return func(**opts)
+    if script is not None:
+        shell = os.environ.get("RUNFUNC_COMPLETION")
+        if shell:
+            sys.stdout.write(completion_script(parser, shell, script))
+            return
+        # Keep an installed completion index in step with the Help class.
+        path = index_path(script)
+        if os.path.exists(path):
+            update_index(parser, path)
+
+    record = setting(help, "record", Recorder)
+    if record is not None:
+        return record.call(parser, func, help, argv)
+    return execute(parser, func, help, argv)
+
+def execute(parser, func, help, argv, streams=None, stats=None):
+    """\
+    Parse `argv` with `parser` and call `func`. `streams` maps the id of
+    argument values to replace, such as the standard streams, to their
+    replacements. If `stats` is a dict the parsed arguments are stored as
+    "opts" and the "start", "parsed" and "end" times of the phases are
+    stored as well.
+    """
+    if stats is None:
+        stats = {}
+    stats["start"] = time.time()
+    try:
+        opts = parser.parse(argv)
+        if streams:
+            for name, value in opts.items():
+                if id(value) in streams:
+                    opts[name] = streams[id(value)]
+        if parser.extras.get("shard") is not None:
+            help["shard"].apply(parser, opts, parser.extras["shard"])
+    except:
+        stats["end"] = time.time()
+        parser.finish(False)
+        raise
+    if parser.extras.get("watch"):
+        return help["watch"].loop(parser, func, help, opts)
+    return call_parsed(parser, func, help, opts, stats)
+
+def call_parsed(parser, func, help, opts, stats=None):
+    """\
+    Call `func` with the arguments `parser` returned and commit or discard
+    the atomic outputs.
+    """
+    if stats is None:
+        stats = {"start": time.time()}
+    cache = setting(help, "cache", Cache)
+    checkpoint = setting(help, "checkpoint", Checkpoint)
+    output = setting(help, "output", Output)
+    mapreduce = setting(help, "mapreduce", MapReduce)
+
+    call = func
+    if mapreduce is not None:
+        call = lambda **opts: mapreduce.call(func, opts)
+    if output is not None:
+        inner = call
+        def call(**opts):
+            ret = inner(**opts)
+            if hasattr(ret, "next"):
+                return output.emit(ret, opts)
+            return ret
+
+    key = entry = None
+    try:
+        if checkpoint is not None:
+            checkpoint.filter(parser, opts)
+        stats["opts"] = opts
+        stats["parsed"] = time.time()
+        if cache is not None:
+            key = cache.key(parser, func, opts)
+        if key is not None:
+            entry = cache.load(key)
+        if entry is not None:
+            ret = cache.replay(entry, opts)
+        elif key is not None:
+            ret, stdout = cache.call(call, opts)
+        else:
+            ret = call(**opts)
+    except:
+        stats["end"] = time.time()
+        parser.finish(False)
+        raise
+    parser.finish(True)
+    if checkpoint is not None:
+        checkpoint.commit()
+    if key is not None and entry is None:
+        cache.save(key, ret, stdout, parser, opts)
+    stats["end"] = time.time()
+    return ret
+
+def phases(stats):
+    """\
+    Return the seconds spent parsing, calling and in total from the times
+    execute() stored in `stats`. Parsing takes the whole time when it fails.
+    """
+    end = stats.get("end", time.time())
+    parsed = stats.get("parsed", end)
+    return {
+        "parse": parsed - stats["start"],
+        "call": end - parsed,
+        "total": end - stats["start"]
+    }
+
+class Redirect(object):
+    """\
+    Stand in for a standard stream and forward to a stream set for the
+    current thread, or to the original stream otherwise.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local, "stream", None) or self.stream
+
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+    def __iter__(self):
+        return iter(self.target())
+
+class Result(object):
+    """\
+    The outcome of an in-process invocation.
+    """
+    def __init__(self, code, stdout, stderr, value=None, exception=None,
+                    timings=None):
+        self.code = code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.value = value
+        self.exception = exception
+        self.timings = timings
+
+    def __repr__(self):
+        return "<Result code=%r stdout=%r stderr=%r>" % (
+            self.code, self.stdout, self.stderr)
+
+_REDIRECT_LOCK = threading.Lock()
+_ENVIRON_LOCK = threading.RLock()
+
+def redirect(name):
+    with _REDIRECT_LOCK:
+        stream = getattr(sys, name)
+        if not isinstance(stream, Redirect):
+            stream = Redirect(stream)
+            setattr(sys, name, stream)
+        return stream
+
+class Harness(object):
+    """\
+    Run a command line function in process, as many times as needed and
+    from any number of threads. Each call gets its own standard input and
+    captured standard output and error. Parsers are built once and reused.
+    """
+    def __init__(self, func, help):
+        self.func = func
+        self.help = help
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def __call__(self, argv=(), stdin="", env=None):
+        """\
+        Run with `argv`, `stdin` as standard input and the variables in
+        `env` added to the environment. Returns a Result with the exit code
+        and the captured output. Changing the environment is process wide,
+        so calls that pass `env` run one at a time.
+        """
+        with self.lock:
+            parser = self.idle.pop() if self.idle else None
+        if parser is None:
+            parser = Parser(self.func, self.help)
+        try:
+            if env is None:
+                return self.invoke(parser, argv, stdin)
+            with _ENVIRON_LOCK:
+                saved = dict(os.environ)
+                os.environ.update(env)
+                try:
+                    return self.invoke(parser, argv, stdin)
+                finally:
+                    os.environ.clear()
+                    os.environ.update(saved)
+        finally:
+            with self.lock:
+                self.idle.append(parser)
+
+    def invoke(self, parser, argv, stdin):
+        names = ("stdin", "stdout", "stderr")
+        redirects = [redirect(name) for name in names]
+        captured = [StringIO(stdin), StringIO(), StringIO()]
+        streams = {}
+        for name, stream in zip(names, captured):
+            streams[id(getattr(sys, "__%s__" % name))] = stream
+        for proxy, stream in zip(redirects, captured):
+            streams[id(proxy.stream)] = stream
+            streams[id(proxy)] = stream
+            proxy.local.stream = stream
+        code, value, exception, stats = 0, None, None, {}
+        try:
+            try:
+                value = execute(parser, self.func, self.help, list(argv),
+                                    streams, stats)
+            except SystemExit, inst:
+                code = inst.code
+                if code is None:
+                    code = 0
+                elif not isinstance(code, (int, long)):
+                    captured[2].write("%s\n" % code)
+                    code = 1
+            except Exception, inst:
+                exception = inst
+                captured[2].write(traceback.format_exc())
+                code = 1
+        finally:
+            for proxy in redirects:
+                proxy.local.stream = None
+        return Result(code, captured[1].getvalue(), captured[2].getvalue(),
+                        value, exception, phases(stats))
+
+_HARNESSES = {}
+_HARNESS_LOCK = threading.Lock()
+
+def invoke(func, help, argv=(), stdin="", env=None):
+    """\
+    Run `func` in process with a Harness that's cached for `func` and the
+    Help class, and return the Result.
+    """
+    key = (func, type(help))
+    with _HARNESS_LOCK:
+        harness = _HARNESSES.get(key)
+        if harness is None:
+            harness = _HARNESSES[key] = Harness(func, help)
+    return harness(argv, stdin, env)
+
+class Recorder(object):
+    """\
+    Append a line of JSON to `path` for every invocation with its argv,
+    the environment variables named in `env`, fingerprints of its input
+    files and how long parsing and calling took. Lines are written with a
+    single append so several processes can share a log.
+    """
+    def __init__(self, path, env=(), name=None):
+        self.path = os.path.expanduser(path)
+        self.env = env
+        self.name = name
+
+    def call(self, parser, func, help, argv):
+        # Parsing consumes generators, so keep a copy to record.
+        argv = list(argv)
+        stats, code = {}, 0
+        try:
+            return execute(parser, func, help, argv, stats=stats)
+        except SystemExit, inst:
+            code = inst.code if isinstance(inst.code, (int, long)) else 1
+            raise
+        except:
+            code = 1
+            raise
+        finally:
+            # Recording must never change the outcome of the run.
+            try:
+                self.append(self.entry(parser, func, help, argv, stats, code))
+            except Exception:
+                pass
+
+    def entry(self, parser, func, help, argv, stats, code):
+        name = getattr(func, "__name__", type(func).__name__)
+        source = getattr(func, "__module__", None)
+        if source == "__main__":
+            obj = func if inspect.isroutine(func) else type(func)
+            try:
+                source = os.path.abspath(inspect.getsourcefile(obj))
+            except (TypeError, AttributeError):
+                pass
+        entry = {
+            "tool": self.name or name,
+            "source": source,
+            "func": name,
+            "help": type(help).__name__,
+            "cwd": os.getcwd(),
+            "argv": list(argv),
+            "env": dict((name, os.environ[name]) for name in self.env
+                            if name in os.environ),
+            "inputs": self.inputs(parser, stats.get("opts", {})),
+            "code": code,
+            "time": stats["start"]
+        }
+        entry.update(phases(stats))
+        return entry
+
+    def inputs(self, parser, opts):
+        paths = {}
+        for name, value in opts.iteritems():
+            arg = parser.args.get(name)
+            if isinstance(value, Matches):
+                paths[name] = list(value.paths())
+            elif isinstance(value, MultiStream):
+                paths[name] = value.paths
+            elif isinstance(arg, Stream) and arg.mode in ("r", "rb") \
+                    and isinstance(value, (file, PrefetchFile)) \
+                    and value is not sys.stdin:
+                paths[name] = [value.name]
+            elif isinstance(arg, Path) and isinstance(value, basestring):
+                paths[name] = [value]
+        ret = {}
+        for name, names in paths.iteritems():
+            ret[name] = [[path] + list(self.fingerprint(path))
+                            for path in names]
+        return ret
+
+    @staticmethod
+    def fingerprint(path):
+        try:
+            return fingerprint(path)
+        except (IOError, OSError):
+            return ()
+
+    @staticmethod
+    def changed(entry):
+        """\
+        Whether any input of a recorded invocation changed since.
+        """
+        for inputs in entry["inputs"].itervalues():
+            for item in inputs:
+                if item[1:] != list(Recorder.fingerprint(item[0])):
+                    return True
+        return False
+
+    def append(self, entry):
+        data = json.dumps(entry, separators=(",", ":")) + "\n"
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+class Report(object):
+    """\
+    Latency samples from replayed invocations, by tool and phase.
+    """
+    PHASES = ("parse", "call", "total")
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self):
+        self.samples = {}
+        self.failed = 0
+        self.changed = 0
+
+    def add(self, tool, timings):
+        phases = self.samples.setdefault(tool, dict((p, []) for p in
+                                                    self.PHASES))
+        for phase in self.PHASES:
+            phases[phase].append(timings[phase])
+
+    @staticmethod
+    def percentile(values, pct):
+        values = sorted(values)
+        rank = int(math.ceil(pct / 100.0 * len(values)))
+        return values[max(0, rank - 1)]
+
+    def summary(self):
+        """\
+        Return {tool: {phase: {"count": n, "p50": s, "p95": s, "p99": s}}}.
+        """
+        ret = {}
+        for tool, phases in self.samples.iteritems():
+            for phase, values in phases.iteritems():
+                stats = {"count": len(values)}
+                for pct in self.PERCENTILES:
+                    stats["p%d" % pct] = self.percentile(values, pct)
+                ret.setdefault(tool, {})[phase] = stats
+        return ret
+
+    def format(self):
+        lines = ["%-20s %-6s %7s %10s %10s %10s" % (
+                    "tool", "phase", "count", "p50 ms", "p95 ms", "p99 ms")]
+        summary = self.summary()
+        for tool in sorted(summary):
+            for phase in self.PHASES:
+                stats = summary[tool][phase]
+                lines.append("%-20s %-6s %7d %10.3f %10.3f %10.3f" % (
+                    tool, phase, stats["count"], stats["p50"] * 1000,
+                    stats["p95"] * 1000, stats["p99"] * 1000))
+        if self.failed:
+            lines.append("%d invocations exited with a different code."
+                            % self.failed)
+        if self.changed:
+            lines.append("%d invocations had inputs that changed since "
+                            "they were recorded." % self.changed)
+        return "\n".join(lines) + "\n"
+
+def resolve(entry):
+    """\
+    Import the function and Help class of a recorded invocation.
+    """
+    source = entry["source"]
+    if source.endswith(".py"):
+        name = "runfunc_replay_%s" % hashlib.sha1(source).hexdigest()[:12]
+        module = sys.modules.get(name) or imp.load_source(name, source)
+    else:
+        __import__(source)
+        module = sys.modules[source]
+    return getattr(module, entry["func"]), getattr(module, entry["help"])()
+
+def replay(path, tools=None, repeat=1):
+    """\
+    Run every invocation recorded in `path` again in process and return a
+    Report of the timings. `tools` maps tool names to (func, help) pairs.
+    Tools that aren't given are imported from where they were recorded.
+    Standard input is empty and output is discarded.
+    """
+    tools = dict(tools or {})
+    harnesses = {}
+    report = Report()
+    cwd = os.getcwd()
+    with open(os.path.expanduser(path)) as handle:
+        entries = [json.loads(line) for line in handle if line.strip()]
+    try:
+        for entry in entries:
+            harness = harnesses.get(entry["tool"])
+            if harness is None:
+                func, help = tools.get(entry["tool"]) or resolve(entry)
+                harness = harnesses[entry["tool"]] = Harness(func, help)
+            if os.path.isdir(entry["cwd"]):
+                os.chdir(entry["cwd"])
+            if Recorder.changed(entry):
+                report.changed += 1
+            for i in range(repeat):
+                result = harness(entry["argv"], env=entry["env"] or None)
+                if result.code != entry["code"]:
+                    report.failed += 1
+                report.add(entry["tool"], result.timings)
+    finally:
+        os.chdir(cwd)
+    return report
@@ -4,14 +4,36 @@
 #
 # This file is part of the run package released under the BSD license.
 #
+import io
+import json
+import operator
 import optparse as op
 import os
+import re
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import unittest
 from StringIO import StringIO
 
 import runfunc as rf
 
+def setUpModule():
+    # Keep the help pages the tests render out of the user's cache.
+    global CACHE_HOME, OLD_CACHE_HOME
+    CACHE_HOME = tempfile.mkdtemp()
+    OLD_CACHE_HOME = os.environ.get("XDG_CACHE_HOME")
+    os.environ["XDG_CACHE_HOME"] = CACHE_HOME
+
+def tearDownModule():
+    if OLD_CACHE_HOME is None:
+        del os.environ["XDG_CACHE_HOME"]
+    else:
+        os.environ["XDG_CACHE_HOME"] = OLD_CACHE_HOME
+    shutil.rmtree(CACHE_HOME)
 
 class ProgNameTest(unittest.TestCase):
     def setUp(self):
@@ -149,6 +171,119 @@ class ListValidateTest(ArgTest):
     def test_validation_error(self):
         self.assertRaises(SystemExit, self.parser.parse_args, ['-f', 'bar'])
 
+def slow_int(value):
+    time.sleep(0.05)
+    return int(value)
+
+class DeferredListTest(BaseTest):
+    def invoke(self, argv, validator=slow_int, workers=4, processes=False):
+        class Help(rf.Help):
+            items = rf.List("Items", opt='i', validator=validator,
+                            workers=workers, processes=processes)
+        return rf.run(lambda items=None: items, Help(), argv=argv,
+                        check=False)
+
+    def args(self, values):
+        return sum([['-i', str(value)] for value in values], [])
+
+    def test_threads(self):
+        start = time.time()
+        self.assertEqual(self.invoke(self.args(range(8))), range(8))
+        self.assertEqual(time.time() - start < 0.3, True)
+
+    def test_processes(self):
+        ret = self.invoke(self.args(range(6)), workers=3, processes=True)
+        self.assertEqual(ret, range(6))
+
+    def test_reports_all(self):
+        argv = self.args(["1", "x", "3", "y"])
+        self.assertRaises(SystemExit, self.invoke, argv)
+        mesg = sys.stderr.getvalue()
+        self.assertEqual("x (" in mesg and "y (" in mesg, True)
+
+    def test_path(self):
+        path = rf.Path(rf.EXISTS, "A path")
+        argv = self.args([__file__, __file__ + ".missing"])
+        self.assertRaises(SystemExit, self.invoke, argv, path)
+        self.assertEqual(self.invoke(argv[:2], path), [__file__])
+
+    def test_default(self):
+        class Help(rf.Help):
+            items = rf.List("Items", opt='i', workers=4,
+                            validator=lambda value: value.split(':'))
+        def func(items=[['a', 'b']]):
+            return items
+        ret = rf.run(func, Help(), argv=[], check=False)
+        self.assertEqual(ret, [['a', 'b']])
+        ret = rf.run(func, Help(), argv=['-i', 'c:d'], check=False)
+        self.assertEqual(ret[-1], ['c', 'd'])
+
+class NumbersTest(ArgTest):
+    def arg(self):
+        self.arg = rf.Numbers("numbers", opt='n', ndarray=False)
+        return self.arg
+
+    def test_values(self):
+        opts, args = self.parser.parse_args(['-n', '1,2', '-n', '5-9:2,-3'])
+        self.assertEqual(args, [])
+        self.assertEqual(opts.foo.typecode, 'l')
+        self.assertEqual(opts.foo.tolist(), [1, 2, 5, 7, 9, -3])
+
+    def test_floats(self):
+        self.arg.typecode, self.arg.convert = 'd', float
+        opts, args = self.parser.parse_args(['-n', '1.5,2'])
+        self.assertEqual(opts.foo.tolist(), [1.5, 2.0])
+
+    def test_file(self):
+        path = os.path.join(os.path.dirname(__file__), "foo.txt")
+        handle = open(path, "w")
+        handle.write("1, 2\n3\t4\n10-12\n")
+        handle.close()
+        try:
+            opts, args = self.parser.parse_args(['-n', '@' + path])
+        finally:
+            os.remove(path)
+        self.assertEqual(opts.foo.tolist(), [1, 2, 3, 4, 10, 11, 12])
+
+    def test_file_with_response_files(self):
+        class Help(rf.Help):
+            fromfile_prefix = "@"
+            ids = rf.Numbers("Ids", opt='n', ndarray=False)
+            user = rf.Check(str, "User", opt='u')
+        def func(ids=None, user=None):
+            return ids.tolist(), user
+        path = os.path.join(os.path.dirname(__file__), "ids.txt")
+        with open(path, "w") as handle:
+            handle.write("1\n2\n3\n")
+        try:
+            for argv in (['-n', '@' + path], ['--ids', '@' + path]):
+                ret = rf.run(func, Help(), argv=argv + ['-u', '@alice'],
+                                check=False)
+                self.assertEqual(ret, ([1, 2, 3], '@alice'))
+        finally:
+            os.remove(path)
+
+    def test_bounds(self):
+        self.arg.min, self.arg.max = 0, 10
+        opts, args = self.parser.parse_args(['-n', '0-11:5'])
+        self.assertEqual(opts.foo.tolist(), [0, 5, 10])
+        for value in ['-1,3', '3,11', '5-11', 'bar', '3-1', '@missing']:
+            self.assertRaises(SystemExit, self.parser.parse_args, ['-n', value])
+
+    def test_ndarray(self):
+        class Help(rf.Help):
+            ids = rf.Numbers("ids", typecode='i')
+        def func(ids=None):
+            pass
+        parser = rf.Parser(func, Help())
+        ids = parser.parse(['--ids', '1-4'])['ids']
+        if rf.numpy is None:
+            self.assertEqual(ids.tolist(), [1, 2, 3, 4])
+        else:
+            self.assertEqual(ids.__class__, rf.numpy.ndarray)
+            self.assertEqual(ids.dtype, rf.numpy.dtype('i'))
+            self.assertEqual(ids.tolist(), [1, 2, 3, 4])
+
 class ChoiceTest(ArgTest):
     def arg(self):
         return rf.Choice(["bar"], "yay")
@@ -188,6 +323,50 @@ class RegexpTest(ArgTest):
     
     def test_validation_error(self):
         self.assertRaises(SystemExit, self.parser.parse_args, ['-r', '#'])
+
+    def test_assigned_pattern(self):
+        class Digits(rf.Regexp):
+            __slots__ = ()
+            def __init__(self, desc, opt=None):
+                rf.Regexp.__init__(self, None, desc, opt=opt)
+                self.pattern = re.compile(r"\d+$")
+        arg = Digits("Digits")
+        self.assertEqual(arg.pattern.pattern, r"\d+$")
+        arg.pattern = "[a-z]+$"
+        self.assertEqual(arg.pattern.match("abc") is not None, True)
+
+    def test_invalid_pattern(self):
+        arg = rf.Regexp("(", "Broken", opt='b')
+        arg.name = 'bar'
+        self.parser.add_option(arg.as_opt(None))
+        self.assertRaises(rf.PatternError, self.parser.parse_args,
+                            ['-b', 'x'])
+
+class PatternCacheTest(unittest.TestCase):
+    def test_lazy(self):
+        arg = rf.Regexp('unused-(', "Never compiled")
+        self.assertEqual(arg.compiled, None)
+        self.assertRaises(Exception, lambda: arg.pattern)
+
+    def test_shared(self):
+        first = rf.Email("One")
+        second = rf.Email("Two")
+        self.assertEqual(first.pattern is second.pattern, True)
+        self.assertEqual(rf.Regexp('a+', "A").pattern is
+                            rf.Regexp('a+', "A", flags=re.I).pattern, False)
+
+    def test_compiled(self):
+        pattern = re.compile('b+')
+        self.assertEqual(rf.Regexp(pattern, "B").pattern is pattern, True)
+
+    def test_bounded(self):
+        cache = rf.PatternCache(size=2)
+        first = cache.compile('a')
+        cache.compile('b')
+        self.assertEqual(cache.compile('a') is first, True)
+        cache.compile('c')
+        self.assertEqual(len(cache.patterns), 2)
+        self.assertEqual((str, 'b', 0) in cache.patterns, False)
     
 class EmailTest(ArgTest):
     def arg(self):
@@ -292,6 +471,342 @@ class StreamTest(ArgTest):
         self.arg.mode = "r"
         self.assertRaises(SystemExit, self.parser.parse_args, ['-r', self.path])
 
+class GlobTest(ArgTest):
+    def arg(self):
+        self.base = os.path.join(os.path.dirname(__file__), "globdir")
+        for name in ["sub", "sub/inner"]:
+            os.makedirs(os.path.join(self.base, name))
+        for name in ["a.txt", "b.txt", "c.log", ".hidden.txt", "sub/d.txt"]:
+            open(os.path.join(self.base, name), "w").close()
+        self.arg = rf.Glob(rf.FILE | rf.EXISTS, "globbed", opt='f')
+        return self.arg
+
+    def tearDown(self):
+        for root, dirs, files in os.walk(self.base, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+            for name in dirs:
+                os.rmdir(os.path.join(root, name))
+        os.rmdir(self.base)
+        super(GlobTest, self).tearDown()
+
+    def path(self, *names):
+        return os.path.join(self.base, *names)
+
+    def test_files(self):
+        opts, args = self.parser.parse_args(['-f', self.path('*.txt')])
+        self.assertEqual(args, [])
+        expect = [self.path('a.txt'), self.path('b.txt')]
+        self.assertEqual(sorted(opts.foo), expect)
+
+    def test_default(self):
+        class Help(rf.Help):
+            files = rf.Glob(rf.FILE, "globbed", opt='f')
+        def func(files=()):
+            return files
+        ret = rf.run(func, Help(), argv=['-f', self.path('*.log')],
+                        check=False)
+        self.assertEqual(list(ret), [self.path('c.log')])
+        self.assertEqual(rf.run(func, Help(), argv=[], check=False), ())
+
+    def test_multiple(self):
+        argv = ['-f', self.path('*.log'), '-f', self.path('*', '*.txt')]
+        opts, args = self.parser.parse_args(argv)
+        self.assertEqual(list(opts.foo), [
+            self.path('c.log'), self.path('sub', 'd.txt')
+        ])
+
+    def test_dirs(self):
+        self.arg.flags = rf.DIR
+        opts, args = self.parser.parse_args(['-f', self.path('*')])
+        self.assertEqual(list(opts.foo), [self.path('sub', '')])
+
+    def test_streams(self):
+        self.arg.mode = "r"
+        opts, args = self.parser.parse_args(['-f', self.path('*.log')])
+        streams = list(opts.foo)
+        self.assertEqual([s.name for s in streams], [self.path('c.log')])
+        self.assertEqual(streams[0].__class__, file)
+
+    def test_literal(self):
+        opts, args = self.parser.parse_args(['-f', self.path('c.log')])
+        self.assertEqual(list(opts.foo), [self.path('c.log')])
+
+    def test_validation_error(self):
+        cases = [
+            self.path('missing.txt'),
+            self.path('missing', '*.txt'),
+        ]
+        for cs in cases:
+            self.assertRaises(SystemExit, self.parser.parse_args, ['-f', cs])
+
+class AtomicStreamTest(BaseTest):
+    def setUp(self):
+        super(AtomicStreamTest, self).setUp()
+        base = os.path.dirname(os.path.abspath(__file__))
+        self.path = os.path.join(base, "foo.txt")
+        class Help(rf.Help):
+            out = rf.Stream("w", "Output", opt='o', atomic=True)
+            fast = rf.Stream("w", "Output", atomic=True, threaded=True,
+                                buffering=4)
+        self.help = Help
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        super(AtomicStreamTest, self).tearDown()
+
+    def leftovers(self):
+        dirname = os.path.dirname(self.path)
+        return [n for n in os.listdir(dirname) if n.startswith(".foo.txt")]
+
+    def test_commit(self):
+        def func(out=None):
+            out.write("partial")
+            self.assertEqual(os.path.exists(self.path), False)
+        rf.run(func, self.help(), argv=['-o', self.path], check=False)
+        self.assertEqual(open(self.path).read(), "partial")
+        self.assertEqual(self.leftovers(), [])
+
+    def test_threaded(self):
+        def func(fast=None):
+            for i in range(100):
+                fast.write("%d\n" % i)
+        rf.run(func, self.help(), argv=['--fast', self.path], check=False)
+        expect = ''.join("%d\n" % i for i in range(100))
+        self.assertEqual(open(self.path).read(), expect)
+
+    def test_threaded_copies(self):
+        stream = rf.AtomicFile(self.path, threaded=True, buffering=1 << 10)
+        buf = bytearray("first")
+        stream.write(buffer(buf))
+        buf[:] = "later"
+        stream.flush()
+        with open(stream.tmpname) as handle:
+            self.assertEqual(handle.read(), "first")
+        stream.commit()
+        self.assertEqual(open(self.path).read(), "first")
+
+    def test_discard(self):
+        def func(out=None):
+            out.write("partial")
+            raise ValueError()
+        argv = ['-o', self.path]
+        self.assertRaises(ValueError, rf.run, func, self.help(), argv=argv,
+                            check=False)
+        self.assertEqual(os.path.exists(self.path), False)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_bad_mode(self):
+        self.assertRaises(ValueError, rf.Stream, "r", "In", atomic=True)
+
+class PrefetchStreamTest(ArgTest):
+    def arg(self):
+        self.path = os.path.join(os.path.dirname(__file__), "foo.txt")
+        self.data = ''.join("line %d\n" % i for i in range(100)) + "end"
+        handle = open(self.path, "w")
+        handle.write(self.data)
+        handle.close()
+        return rf.Stream("r", "stream", opt='f', buffering=7, prefetch=True)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        super(PrefetchStreamTest, self).tearDown()
+
+    def stream(self):
+        opts, args = self.parser.parse_args(['-f', self.path])
+        self.assertEqual(opts.foo.__class__, rf.PrefetchFile)
+        return opts.foo
+
+    def test_lines(self):
+        with self.stream() as stream:
+            self.assertEqual(list(stream), self.data.splitlines(True))
+
+    def test_read(self):
+        with self.stream() as stream:
+            self.assertEqual(stream.read(3), self.data[:3])
+            self.assertEqual(stream.readline(), self.data[3:7])
+            self.assertEqual(stream.read(), self.data[7:])
+            self.assertEqual(stream.read(), '')
+
+    def test_readinto(self):
+        buf = bytearray(5)
+        parts = []
+        with self.stream() as stream:
+            while True:
+                size = stream.readinto(buf)
+                if not size:
+                    break
+                parts.append(str(buf[:size]))
+        self.assertEqual(''.join(parts), self.data)
+
+    def test_early_close(self):
+        stream = self.stream()
+        stream.readline()
+        stream.close()
+        self.assertEqual(stream.raw.closed, True)
+
+    def test_bad_mode(self):
+        self.assertRaises(ValueError, rf.Stream, "w", "Out", prefetch=True)
+
+@unittest.skipIf(rf.numpy is None, "NumPy is not installed.")
+class ArrayTest(ArgTest):
+    def arg(self):
+        self.paths = set()
+        self.arg = rf.Array("numbers", opt='a', dtype='float64')
+        return self.arg
+
+    def tearDown(self):
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+        super(ArrayTest, self).tearDown()
+
+    def write(self, ext, data):
+        self.path = os.path.join(os.path.dirname(__file__), "foo" + ext)
+        self.paths.add(self.path)
+        if isinstance(data, str):
+            handle = open(self.path, "wb")
+            handle.write(data)
+            handle.close()
+        elif ext == ".npy":
+            rf.numpy.save(self.path, data)
+        else:
+            data.tofile(self.path)
+        return self.path
+
+    def parse(self, path):
+        opts, args = self.parser.parse_args(['-a', path])
+        self.assertEqual(args, [])
+        return opts.foo
+
+    def test_npy(self):
+        data = rf.numpy.arange(12.0).reshape(4, 3)
+        self.arg.shape = (None, 3)
+        arr = self.parse(self.write(".npy", data))
+        self.assertEqual(isinstance(arr, rf.numpy.memmap), True)
+        self.assertEqual(arr.tolist(), data.tolist())
+
+    def test_raw(self):
+        data = rf.numpy.arange(12.0)
+        self.arg.shape = (None, 4)
+        arr = self.parse(self.write(".bin", data))
+        self.assertEqual(arr.shape, (3, 4))
+        self.assertEqual(arr.ravel().tolist(), data.tolist())
+
+    def test_csv(self):
+        chunksize, rf.Array.CHUNKSIZE = rf.Array.CHUNKSIZE, 7
+        try:
+            arr = self.parse(self.write(".csv", "1,2.5\r\n3,4\n5,6"))
+            self.assertEqual(arr.tolist(), [[1, 2.5], [3, 4], [5, 6]])
+            self.arg.shape = (None,)
+            arr = self.parse(self.write(".csv", "1\n2\n3\n"))
+            self.assertEqual(arr.tolist(), [1, 2, 3])
+        finally:
+            rf.Array.CHUNKSIZE = chunksize
+
+    def test_checks(self):
+        self.arg.min, self.arg.max, self.arg.finite = 0, 10, True
+        arr = self.parse(self.write(".csv", "0,10\n"))
+        self.assertEqual(arr.tolist(), [[0, 10]])
+
+    def test_validation_error(self):
+        self.arg.min, self.arg.max, self.arg.finite = 0, 10, True
+        cases = [
+            (".csv", "1,2\n3\n"),
+            (".csv", "1,2,3\n4\n5,6\n"),
+            (".csv", "1,2,3\n4,5\n6,7,8,9\n"),
+            (".csv", "1,two\n"),
+            (".csv", "-1,2\n"),
+            (".csv", "1,11\n"),
+            (".csv", "1,nan\n"),
+            (".bin", "abc"),
+            (".npy", rf.numpy.arange(3, dtype='complex128')),
+        ]
+        for cs in cases:
+            path = self.write(*cs)
+            self.assertRaises(SystemExit, self.parser.parse_args, ['-a', path])
+        self.arg.shape = (2, 2)
+        path = self.write(".npy", rf.numpy.arange(3.0))
+        self.assertRaises(SystemExit, self.parser.parse_args, ['-a', path])
+
+class PassthroughTest(BaseTest):
+    def setUp(self):
+        super(PassthroughTest, self).setUp()
+        self.src = os.path.join(os.path.dirname(__file__), "foo.txt")
+        self.dst = os.path.join(os.path.dirname(__file__), "bar.txt")
+        self.data = ''.join("line %d\n" % i for i in range(1000))
+        handle = open(self.src, "w")
+        handle.write(self.data)
+        handle.close()
+        self.sendfile = rf.sendfile
+
+    def tearDown(self):
+        rf.sendfile = self.sendfile
+        for path in (self.src, self.dst):
+            if os.path.exists(path):
+                os.remove(path)
+        super(PassthroughTest, self).tearDown()
+
+    def copy(self, src):
+        with open(self.dst, "wb") as dst:
+            dst.write("head\n")
+            total = rf.passthrough(src, dst, bufsize=100)
+        return total, open(self.dst).read()
+
+    def expect(self):
+        return len(self.data), "head\n" + self.data
+
+    def test_readinto(self):
+        rf.sendfile = None
+        with open(self.src, "rb") as src:
+            self.assertEqual(self.copy(src), self.expect())
+
+    def test_read(self):
+        src = StringIO(self.data)
+        self.assertEqual(self.copy(src), self.expect())
+
+    def test_sendfile(self):
+        calls = []
+        def sendfile(outfd, infd, offset, count):
+            calls.append(offset)
+            os.lseek(infd, offset, os.SEEK_SET)
+            return os.write(outfd, os.read(infd, count))
+        rf.sendfile = sendfile
+        with open(self.src, "rb") as src:
+            self.assertEqual(self.copy(src), self.expect())
+            self.assertEqual(src.read(), "")
+        self.assertEqual(len(calls) > 1, True)
+
+    def atomic_copy(self, src):
+        dst = rf.AtomicFile(self.dst, "wb", buffering=1 << 16, threaded=True)
+        dst.write("head\n")
+        total = rf.passthrough(src, dst, bufsize=100)
+        dst.write("tail\n")
+        dst.commit()
+        return total, open(self.dst).read()
+
+    def test_threaded_atomic(self):
+        rf.sendfile = None
+        expect = (len(self.data), "head\n" + self.data + "tail\n")
+        self.assertEqual(self.atomic_copy(io.BytesIO(self.data)), expect)
+        def sendfile(outfd, infd, offset, count):
+            os.lseek(infd, offset, os.SEEK_SET)
+            return os.write(outfd, os.read(infd, count))
+        rf.sendfile = sendfile
+        with open(self.src, "rb") as src:
+            self.assertEqual(self.atomic_copy(src), expect)
+
+    def test_buffered_source(self):
+        def sendfile(outfd, infd, offset, count):
+            self.fail("Copied from a descriptor with buffered data.")
+        rf.sendfile = sendfile
+        with open(self.src, "rb") as src:
+            first = src.readline()
+            total, data = self.copy(src)
+        self.assertEqual(data, "head\n" + self.data[len(first):])
+
 class HelpTest(unittest.TestCase):
     def test_basic(self):
         class Help(rf.Help):
@@ -382,6 +897,1032 @@ class ParserBasicTests(BaseTest):
         parser = rf.Parser(throw, Help())
         self.assertRaises(SystemExit, parser.parse, ["foo"])
 
+class ResponseFileTest(BaseTest):
+    def setUp(self):
+        super(ResponseFileTest, self).setUp()
+        class Help(rf.Help):
+            fromfile_prefix = "@"
+            foo = rf.Check(int, "Foo option")
+            bar = rf.List("Bar option", opt='b', validator=int)
+        self.help = Help
+        self.path = os.path.join(os.path.dirname(__file__), "args.txt")
+        self.nested = os.path.join(os.path.dirname(__file__), "nested.txt")
+
+    def tearDown(self):
+        for path in (self.path, self.nested):
+            if os.path.exists(path):
+                os.remove(path)
+        super(ResponseFileTest, self).tearDown()
+
+    def write(self, path, lines):
+        handle = open(path, "w")
+        handle.write("\n".join(lines) + "\n")
+        handle.close()
+
+    def test_generator(self):
+        def func(foo, bar=None):
+            pass
+        parser = rf.Parser(func, self.help())
+        argv = (arg for arg in ['-b', '1', '2', '--bar', '3'])
+        self.assertEqual(parser.parse(argv), {'foo': 2, 'bar': [1, 3]})
+
+    def test_response_file(self):
+        def func(foo, bar=None):
+            pass
+        self.write(self.nested, ['-b', '3'])
+        self.write(self.path, ['-b', '1', '-b', '2', '@' + self.nested])
+        parser = rf.Parser(func, self.help())
+        ret = parser.parse(['@' + self.path, '4'])
+        self.assertEqual(ret, {'foo': 4, 'bar': [1, 2, 3]})
+
+    def test_missing_file(self):
+        def func(bar=None):
+            pass
+        parser = rf.Parser(func, self.help())
+        self.assertRaises(SystemExit, parser.parse, ['@' + self.path])
+
+    def test_disabled(self):
+        class Help(rf.Help):
+            bar = rf.List("Bar option", opt='b')
+        def func(bar=None):
+            pass
+        parser = rf.Parser(func, Help())
+        self.assertEqual(parser.parse(['-b', '@1']), {'bar': ['@1']})
+
+    def test_stops_at_extra(self):
+        def func(foo):
+            pass
+        def argv():
+            yield '1'
+            yield '2'
+            self.fail("Consumed past the first unexpected argument.")
+        parser = rf.Parser(func, self.help())
+        self.assertRaises(SystemExit, parser.parse, argv())
+
+class LazyParserTest(BaseTest):
+    def setUp(self):
+        super(LazyParserTest, self).setUp()
+        attrs = {"flag": rf.Flag("A flag", opt='f'), "all_options": True}
+        for idx in range(100):
+            attrs["opt_%d" % idx] = rf.Check(int, "Option %d" % idx)
+        self.help = type("Help", (rf.Help,), attrs)
+
+    def test_slots(self):
+        self.assertEqual(hasattr(self.help()["opt_1"], "__dict__"), False)
+
+    def test_shared(self):
+        class Help(self.help):
+            extra = rf.Flag("Extra")
+        self.assertEqual(Help._args.local.keys(), ["extra"])
+        self.assertEqual(Help()["opt_5"] is self.help()["opt_5"], True)
+        self.assertEqual(len(Help._args), 102)
+        self.assertEqual(sorted(Help())[:2], ["extra", "flag"])
+
+    def test_deferred(self):
+        def func(**opts):
+            return opts
+        parser = rf.Parser(func, self.help())
+        ret = parser.parse(['--opt-7', '3', '--opt-99=4', '-f'])
+        self.assertEqual(ret["opt_7"], 3)
+        self.assertEqual(ret["opt_99"], 4)
+        self.assertEqual(ret["flag"], True)
+        self.assertEqual(ret["opt_8"], None)
+        self.assertEqual(len(ret), 101)
+        self.assertEqual(len(parser._pending), 98)
+
+    def test_conflicts(self):
+        class Help(rf.Help):
+            host = rf.Check(str, "Host", opt='h')
+        self.assertRaises(op.OptionConflictError, rf.Parser,
+                            lambda host=None: host, Help())
+        class Help(rf.Help):
+            first = rf.Check(str, "First", opt='x')
+            second = rf.Check(str, "Second", opt='x')
+        self.assertRaises(op.OptionConflictError, rf.Parser,
+                            lambda first=None, second=None: None, Help())
+
+    def test_kwargs_opt_in(self):
+        class Help(rf.Help):
+            debug = rf.Flag("Debug")
+            other = rf.Check(int, "Other")
+        def func(**opts):
+            return opts
+        self.assertEqual(rf.run(func, Help(), argv=[], check=False), {})
+        self.assertRaises(SystemExit, rf.run, func, Help(), argv=['--debug'],
+                            check=False)
+
+    def test_abbreviation(self):
+        def func(opt_42=None, opt_7=None):
+            pass
+        parser = rf.Parser(func, self.help())
+        self.assertEqual(parser.parse(['--opt-4', '1']), {
+            "opt_42": 1, "opt_7": None
+        })
+
+    def test_help(self):
+        def func(opt_2=None, flag=False, opt_1=None):
+            pass
+        parser = rf.Parser(func, self.help())
+        parser.parse(['--opt-1', '1'])
+        opts = [str(opt) for opt in parser.option_list]
+        self.assertEqual(opts, ["-h/--help", "--opt-2", "-f/--flag", "--opt-1"])
+        self.assertEqual(parser.has_option("--opt-2"), True)
+        self.assertEqual(parser.get_option("--opt-2").default, None)
+
+class CompletionTest(BaseTest):
+    def setUp(self):
+        super(CompletionTest, self).setUp()
+        class Help(rf.Help):
+            mode = rf.Choice(["fast", "slow"], "Mode", opt='m')
+            out = rf.Path(rf.DIR, "Output directory")
+            verbose = rf.Flag("Verbose", opt='v')
+            src = rf.Stream("r", "Source")
+        def func(src, mode="fast", out=None, verbose=False):
+            pass
+        self.parser = rf.Parser(func, Help())
+        self.script = os.path.join(os.path.dirname(__file__), "tool.py")
+        self.index = rf.index_path(self.script)
+
+    def tearDown(self):
+        if os.path.exists(self.index):
+            os.remove(self.index)
+        super(CompletionTest, self).tearDown()
+
+    def complete(self, *words):
+        rf.update_index(self.parser, self.index)
+        argv = [sys.executable, "-S", "-c", rf.COMPLETER, self.index,
+                    str(len(words)), "tool.py"] + list(words)
+        out = subprocess.Popen(argv, stdout=subprocess.PIPE).communicate()[0]
+        return out.splitlines()
+
+    def test_index(self):
+        self.assertEqual(self.index, os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), ".tool.py.complete"
+        ))
+        self.assertEqual(self.parser.completion_index().splitlines(), [
+            rf.INDEX_HEADER,
+            "-h --help\tflag\t",
+            "-m --mode\twords\tfast slow",
+            "--out\tdir\t",
+            "-v --verbose\tflag\t",
+            "\tfile\t"
+        ])
+
+    def test_update(self):
+        self.assertEqual(rf.update_index(self.parser, self.index), True)
+        self.assertEqual(rf.update_index(self.parser, self.index), False)
+        self.parser.args["mode"].choices.append("safe")
+        self.assertEqual(rf.update_index(self.parser, self.index), True)
+
+    def test_complete(self):
+        self.assertEqual(self.complete("--mo"), [
+            "words", ":--mo", ":", "--mode"
+        ])
+        self.assertEqual(self.complete("-m", "s"), [
+            "words", ":s", ":", "slow"
+        ])
+        self.assertEqual(self.complete("--mode=f"), [
+            "words", ":f", ":--mode=", "--mode=fast"
+        ])
+        self.assertEqual(self.complete("--mode", "=", "f"), [
+            "words", ":f", ":", "fast"
+        ])
+        self.assertEqual(self.complete("--out", "a"), ["dir", ":a", ":"])
+        self.assertEqual(self.complete("-v", "x"), ["file", ":x", ":"])
+
+    def test_script(self):
+        for shell in ["bash", "zsh", "fish"]:
+            code = rf.completion_script(self.parser, shell, self.script)
+            self.assertEqual("_runfunc_tool_py" in code, True)
+            self.assertEqual(self.index in code, True)
+        self.assertRaises(ValueError, rf.completion_script, self.parser,
+                            "csh", self.script)
+
+class CacheTest(BaseTest):
+    def setUp(self):
+        super(CacheTest, self).setUp()
+        base = os.path.dirname(__file__)
+        self.dir = os.path.join(base, "cache")
+        self.src = os.path.join(base, "foo.txt")
+        self.dst = os.path.join(base, "bar.txt")
+        self.write(self.src, "input")
+        self.calls = []
+        class Help(rf.Help):
+            cache = rf.Cache(self.dir)
+            src = rf.Stream("r", "Input")
+            dst = rf.Stream("w", "Output", opt='o', atomic=True)
+            count = rf.Check(int, "Count", opt='c')
+        self.help = Help
+        def func(src, dst=None, count=1):
+            self.calls.append(count)
+            data = src.read()
+            print data * count
+            if dst is not None:
+                dst.write(data.upper())
+            return len(data) * count
+        self.func = func
+
+    def tearDown(self):
+        for path in (self.src, self.dst):
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.isdir(self.dir):
+            for name in os.listdir(self.dir):
+                os.remove(os.path.join(self.dir, name))
+            os.rmdir(self.dir)
+        super(CacheTest, self).tearDown()
+
+    def write(self, path, data):
+        handle = open(path, "w")
+        handle.write(data)
+        handle.close()
+
+    def invoke(self, *argv):
+        argv = list(argv) + [self.src]
+        return rf.run(self.func, self.help(), argv=argv, check=False)
+
+    def test_replay(self):
+        self.assertEqual(self.invoke('-c', '2'), 10)
+        self.assertEqual(self.invoke('-c', '2'), 10)
+        self.assertEqual(self.calls, [2])
+        self.assertEqual(sys.stdout.getvalue(), "inputinput\n" * 2)
+        self.assertEqual(self.invoke('-c', '3'), 15)
+        self.assertEqual(self.calls, [2, 3])
+
+    def test_changed_input(self):
+        self.invoke()
+        self.write(self.src, "longer input")
+        os.utime(self.src, (0, 0))
+        self.assertEqual(self.invoke(), 12)
+        self.assertEqual(self.calls, [1, 1])
+
+    def test_outputs(self):
+        self.invoke('-o', self.dst)
+        os.remove(self.dst)
+        self.invoke('-o', self.dst)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(open(self.dst).read(), "INPUT")
+
+    def test_plain_output(self):
+        class Help(self.help):
+            dst = rf.Stream("w", "Output", opt='o')
+        for i in range(2):
+            rf.run(self.func, Help(), argv=['-o', self.dst, self.src],
+                    check=False)
+            self.assertEqual(open(self.dst).read(), "INPUT")
+        self.assertEqual(self.calls, [1])
+
+    def test_option_named_cache(self):
+        class Help(rf.Help):
+            cache = rf.Flag("Use the cache")
+        ret = rf.run(lambda cache=False: cache, Help(), argv=['--cache'],
+                        check=False)
+        self.assertEqual(ret, True)
+
+    def test_uncacheable(self):
+        cache = rf.Cache(self.dir)
+        parser = rf.Parser(self.func, self.help())
+        opts = {"src": sys.stdin, "dst": None, "count": 1}
+        self.assertEqual(cache.key(parser, self.func, opts), None)
+
+    def test_evict(self):
+        self.help.cache.limit = 1
+        self.invoke()
+        self.assertEqual(os.listdir(self.dir), [])
+        self.invoke()
+        self.assertEqual(self.calls, [1, 1])
+
+class CheckpointTest(BaseTest):
+    def setUp(self):
+        super(CheckpointTest, self).setUp()
+        self.base = os.path.join(os.path.dirname(__file__), "inputs")
+        os.mkdir(self.base)
+        for name in ["a.txt", "b.txt"]:
+            self.write(name, name)
+        self.state = os.path.join(os.path.dirname(__file__), "state.json")
+        class Help(rf.Help):
+            checkpoint = rf.Checkpoint(self.state)
+            files = rf.Glob(rf.FILE, "Input files", opt='f')
+        self.help = Help
+        self.fail_run = False
+
+    def tearDown(self):
+        for name in os.listdir(self.base):
+            os.remove(os.path.join(self.base, name))
+        os.rmdir(self.base)
+        if os.path.exists(self.state):
+            os.remove(self.state)
+        super(CheckpointTest, self).tearDown()
+
+    def write(self, name, data, mtime=None):
+        path = os.path.join(self.base, name)
+        handle = open(path, "w")
+        handle.write(data)
+        handle.close()
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def invoke(self):
+        def func(files=None):
+            ret = sorted(os.path.basename(path) for path in files)
+            if self.fail_run:
+                raise ValueError()
+            return ret
+        argv = ['-f', os.path.join(self.base, '*.txt')]
+        return rf.run(func, self.help(), argv=argv, check=False)
+
+    def test_incremental(self):
+        self.assertEqual(self.invoke(), ["a.txt", "b.txt"])
+        self.assertEqual(self.invoke(), [])
+        self.write("b.txt", "changed", mtime=0)
+        self.write("c.txt", "new")
+        self.assertEqual(self.invoke(), ["b.txt", "c.txt"])
+        self.assertEqual(self.invoke(), [])
+
+    def test_failure(self):
+        self.fail_run = True
+        self.assertRaises(ValueError, self.invoke)
+        self.assertEqual(os.path.exists(self.state), False)
+        self.fail_run = False
+        self.assertEqual(self.invoke(), ["a.txt", "b.txt"])
+
+    def test_option_named_checkpoint(self):
+        class Help(rf.Help):
+            checkpoint = rf.Check(int, "Checkpoint", opt='c')
+        ret = rf.run(lambda checkpoint=0: checkpoint, Help(),
+                        argv=['-c', '3'], check=False)
+        self.assertEqual(ret, 3)
+        self.assertEqual(os.path.exists(self.state), False)
+
+class ShardTest(BaseTest):
+    def setUp(self):
+        super(ShardTest, self).setUp()
+        self.path = os.path.join(os.path.dirname(__file__), "shard.txt")
+        self.lines = ["line %d\n" % i for i in range(1000)]
+        with open(self.path, "w") as handle:
+            handle.write(''.join(self.lines))
+
+    def tearDown(self):
+        os.remove(self.path)
+        super(ShardTest, self).tearDown()
+
+    def invoke(self, mode, shard, argv=()):
+        class Help(rf.Help):
+            shard = rf.Shard(mode=mode)
+            items = rf.List("Items", opt='i', validator=int)
+            infile = rf.Stream("r", "Input", opt='f')
+        def func(items=None, infile=None):
+            return items, infile and list(infile)
+        return rf.run(func, Help(), argv=["--shard", shard] + list(argv),
+                        check=False)
+
+    def collect(self, mode, count, argv):
+        return [self.invoke(mode, "%d/%d" % (i, count), argv)
+                    for i in range(count)]
+
+    def test_list(self):
+        items = sum([['-i', str(i)] for i in range(100)], [])
+        for mode in ["hash", "range"]:
+            parts = [p[0] for p in self.collect(mode, 3, items)]
+            self.assertEqual(sorted(sum(parts, [])), range(100))
+        self.assertEqual(self.invoke("range", "1/4", items)[0],
+                            range(25, 50))
+
+    def test_stream(self):
+        for mode in ["hash", "range"]:
+            for count in [1, 3, 7]:
+                parts = [p[1] for p in self.collect(mode, count,
+                                                    ['-f', self.path])]
+                self.assertEqual(sorted(sum(parts, [])), sorted(self.lines))
+
+    def test_range_file(self):
+        size = os.path.getsize(self.path)
+        handle = open(self.path)
+        rf.RangeFile.BUFSIZE = 10
+        try:
+            lines = list(rf.RangeFile(handle, 5, size // 2))
+        finally:
+            rf.RangeFile.BUFSIZE = 1 << 20
+            handle.close()
+        self.assertEqual(lines[0], self.lines[1])
+        self.assertEqual(''.join(self.lines).index(lines[-1]) < size // 2,
+                            True)
+
+    def test_glob(self):
+        class Help(rf.Help):
+            shard = rf.Shard()
+            files = rf.Glob(rf.FILE, "Input files", opt='g')
+        func = lambda files=None: list(files.paths())
+        pattern = os.path.join(os.path.dirname(__file__), "*.py")
+        full = rf.run(func, Help(), argv=['-g', pattern], check=False)
+        parts = [rf.run(func, Help(), argv=['-g', pattern, '--shard',
+                        "%d/2" % i], check=False) for i in range(2)]
+        self.assertEqual(sorted(parts[0] + parts[1]), sorted(full))
+
+    def test_invalid(self):
+        for value in ["3/3", "1", "a/b", "0/0"]:
+            self.assertRaises(SystemExit, self.invoke, "hash", value)
+        self.assertRaises(ValueError, rf.Shard, mode="modulo")
+
+    def test_own_parameter(self):
+        class Help(rf.Help):
+            shard = rf.Shard()
+        ret = rf.run(lambda shard=None: shard, Help(), argv=['--shard', '1/2'],
+                        check=False)
+        self.assertEqual(ret, (1, 2))
+
+def count_words(infile=None):
+    return sum(len(line.split()) for line in infile)
+
+def collect_lines(infile=None):
+    return list(infile)
+
+class MapReduceTest(BaseTest):
+    def setUp(self):
+        super(MapReduceTest, self).setUp()
+        self.path = os.path.join(os.path.dirname(__file__), "mapreduce.txt")
+        self.lines = ["%d %s\n" % (i, "word " * (i % 7)) for i in range(2000)]
+        with open(self.path, "w") as handle:
+            handle.write(''.join(self.lines))
+
+    def tearDown(self):
+        os.remove(self.path)
+        super(MapReduceTest, self).tearDown()
+
+    def invoke(self, func, reduce, workers, chunksize=1 << 26, argv=None):
+        class Help(rf.Help):
+            mapreduce = rf.MapReduce("infile", reduce, workers, chunksize)
+            infile = rf.Stream("r", "Input", opt='f')
+        if argv is None:
+            argv = ['-f', self.path]
+        return rf.run(func, Help(), argv=argv, check=False)
+
+    def test_counts(self):
+        expect = sum(len(line.split()) for line in self.lines)
+        for workers in [1, 3]:
+            ret = self.invoke(count_words, operator.add, workers, 1000)
+            self.assertEqual(ret, expect)
+
+    def test_order(self):
+        for chunksize in [1, 13, 4096]:
+            ret = self.invoke(collect_lines, operator.add, 2, chunksize)
+            self.assertEqual(ret, self.lines)
+
+    def test_mapped_range(self):
+        data = "ab\ncd\nef"
+        ranges = [rf.MappedRange(data, i, j) for i, j in
+                    [(0, 1), (1, 4), (4, 5), (5, 9)]]
+        self.assertEqual([list(r) for r in ranges],
+                            [["ab\n"], ["cd\n"], [], ["ef"]])
+        self.assertEqual(str(ranges[1].view()), "cd\n")
+        self.assertEqual(rf.MappedRange(data, 5, 9).read(1), "e")
+
+    def test_not_regular(self):
+        mapreduce = rf.MapReduce("infile", operator.add, 2)
+        ret = mapreduce.call(count_words, {"infile": StringIO("a b\nc\n")})
+        self.assertEqual(ret, 3)
+
+    def test_option_named_mapreduce(self):
+        class Help(rf.Help):
+            mapreduce = rf.Flag("Split the work", opt='m')
+        ret = rf.run(lambda mapreduce=False: mapreduce, Help(), argv=['-m'],
+                        check=False)
+        self.assertEqual(ret, True)
+
+class MultiStreamTest(BaseTest):
+    def setUp(self):
+        super(MultiStreamTest, self).setUp()
+        base = os.path.dirname(__file__)
+        self.paths = []
+        for i in range(5):
+            path = os.path.join(base, "multi%d.txt" % i)
+            with open(path, "w") as handle:
+                for j in range(i, 60, 5):
+                    handle.write("%03d %d\n" % (j, i))
+            self.paths.append(path)
+
+    def tearDown(self):
+        for path in self.paths:
+            os.remove(path)
+        super(MultiStreamTest, self).tearDown()
+
+    def invoke(self, order, key=None, maxopen=64, argv=None):
+        class Help(rf.Help):
+            logs = rf.Streams("Logs", opt='l', order=order, key=key,
+                                maxopen=maxopen)
+        if argv is None:
+            argv = sum([['-l', path] for path in self.paths], [])
+        return rf.run(lambda logs=None: list(logs), Help(), argv=argv,
+                        check=False)
+
+    def test_concat(self):
+        lines = self.invoke("concat", maxopen=1)
+        self.assertEqual(len(lines), 60)
+        self.assertEqual(lines[:2], ["000 0\n", "005 0\n"])
+
+    def test_roundrobin(self):
+        lines = self.invoke("roundrobin", maxopen=2)
+        self.assertEqual([int(line.split()[0]) for line in lines], range(60))
+
+    def test_merge(self):
+        for maxopen in [1, 2, 64]:
+            lines = self.invoke("merge", maxopen=maxopen)
+            self.assertEqual(lines, sorted(lines))
+            self.assertEqual(len(lines), 60)
+
+    def test_merge_key(self):
+        key = lambda line: -int(line.split()[0])
+        for path in self.paths:
+            with open(path) as handle:
+                lines = handle.readlines()
+            with open(path, "w") as handle:
+                handle.write(''.join(reversed(lines)))
+        lines = self.invoke("merge", key=key)
+        self.assertEqual([-key(line) for line in lines], range(59, -1, -1))
+
+    def test_limit(self):
+        stream = rf.MultiStream(self.paths, "roundrobin", maxopen=3,
+                                bufsize=1)
+        for line in stream:
+            self.assertEqual(len(stream.handles.open) <= 3, True)
+        self.assertEqual(stream.handles, None)
+
+    def test_missing(self):
+        argv = ['-l', self.paths[0] + ".missing"]
+        self.assertRaises(SystemExit, self.invoke, "concat", argv=argv)
+        self.assertRaises(ValueError, rf.Streams, "Logs", order="zip")
+
+def echo(count=1, upper=False, infile=sys.stdin):
+    data = infile.read()
+    if upper:
+        data = data.upper()
+    sys.stdout.write(data * count)
+    if os.environ.get("ECHO_FAIL"):
+        raise ValueError("failed")
+    return count
+
+class EchoHelp(rf.Help):
+    count = rf.Check(int, "Repeat count", opt='c')
+    upper = rf.Flag("Upper case", opt='u')
+    infile = rf.Stream("r", "Input", opt='i')
+
+class HarnessTest(unittest.TestCase):
+    def test_capture(self):
+        ret = rf.invoke(echo, EchoHelp(), ['-c', '2'], stdin="ab")
+        self.assertEqual((ret.code, ret.stdout, ret.value), (0, "abab", 2))
+        self.assertEqual(ret.stderr, "")
+
+    def test_parse_error(self):
+        ret = rf.invoke(echo, EchoHelp(), ['-c', 'x'])
+        self.assertEqual(ret.code, 2)
+        self.assertEqual("Invalid value" in ret.stderr, True)
+        self.assertEqual(ret.stdout, "")
+
+    def test_exception(self):
+        ret = rf.invoke(echo, EchoHelp(), stdin="a", env={"ECHO_FAIL": "1"})
+        self.assertEqual(ret.code, 1)
+        self.assertEqual(isinstance(ret.exception, ValueError), True)
+        self.assertEqual("ValueError: failed" in ret.stderr, True)
+        self.assertEqual("ECHO_FAIL" in os.environ, False)
+
+    def test_reuses_parser(self):
+        harness = rf.Harness(echo, EchoHelp())
+        harness(['-u'], stdin="a")
+        ret = harness([], stdin="b")
+        self.assertEqual(ret.stdout, "b")
+        self.assertEqual(len(harness.idle), 1)
+
+    def test_threads(self):
+        harness = rf.Harness(echo, EchoHelp())
+        results = {}
+        def worker(i):
+            for j in range(20):
+                data = "%d-%d;" % (i, j)
+                ret = harness(['-c', '2'], stdin=data)
+                results[(i, j)] = ret.stdout == data * 2 and ret.code == 0
+        threads = [threading.Thread(target=worker, args=(i,))
+                    for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 160)
+        self.assertEqual(all(results.values()), True)
+
+class RecordedHelp(EchoHelp):
+    pass
+
+class RecordTest(BaseTest):
+    def setUp(self):
+        super(RecordTest, self).setUp()
+        self.log = os.path.join(os.path.dirname(__file__), "record.log")
+        self.input = os.path.join(os.path.dirname(__file__), "record.txt")
+        with open(self.input, "w") as handle:
+            handle.write("abc")
+        RecordedHelp.record = rf.Recorder(self.log, env=["RECORD_VAR"])
+
+    def tearDown(self):
+        del RecordedHelp.record
+        for path in [self.log, self.input]:
+            if os.path.exists(path):
+                os.remove(path)
+        super(RecordTest, self).tearDown()
+
+    def entries(self):
+        with open(self.log) as handle:
+            return [json.loads(line) for line in handle]
+
+    def test_record(self):
+        os.environ["RECORD_VAR"] = "x"
+        try:
+            rf.run(echo, RecordedHelp(), ['-c', '2', '-i', self.input],
+                    check=False)
+        finally:
+            del os.environ["RECORD_VAR"]
+        self.assertRaises(SystemExit, rf.run, echo, RecordedHelp(),
+                            ['-c', 'x'], check=False)
+        first, second = self.entries()
+        self.assertEqual(first["argv"], ['-c', '2', '-i', self.input])
+        self.assertEqual(first["env"], {"RECORD_VAR": "x"})
+        self.assertEqual((first["tool"], first["source"], first["func"],
+                            first["help"]), ("echo", "test", "echo",
+                            "RecordedHelp"))
+        self.assertEqual(first["inputs"]["infile"][0][:2], [self.input, 3])
+        self.assertEqual(first["code"], 0)
+        self.assertEqual(second["code"], 2)
+        for entry in (first, second):
+            self.assertEqual(entry["total"] >= entry["parse"] >= 0, True)
+
+    def test_replay(self):
+        for count in range(1, 4):
+            rf.run(echo, RecordedHelp(), ['-c', str(count), '-i',
+                    self.input], check=False)
+        report = rf.replay(self.log, repeat=3)
+        summary = report.summary()
+        self.assertEqual(summary.keys(), ["echo"])
+        self.assertEqual(summary["echo"]["call"]["count"], 9)
+        stats = summary["echo"]["total"]
+        self.assertEqual(stats["p50"] <= stats["p95"] <= stats["p99"], True)
+        self.assertEqual((report.failed, report.changed), (0, 0))
+        self.assertEqual("p99 ms" in report.format(), True)
+        with open(self.input, "w") as handle:
+            handle.write("changed")
+        self.assertEqual(rf.replay(self.log).changed, 3)
+
+    def test_generator_argv(self):
+        argv = iter(['-c', '2', '-i', self.input])
+        self.assertEqual(rf.run(echo, RecordedHelp(), argv, check=False), 2)
+        self.assertEqual(self.entries()[0]["argv"],
+                            ['-c', '2', '-i', self.input])
+
+    def test_callable_object(self):
+        class Echo(object):
+            def __call__(self, count=1, upper=False, infile=sys.stdin):
+                return count
+        ret = rf.run(Echo(), RecordedHelp(), ['-c', '3'], check=False)
+        self.assertEqual(ret, 3)
+        entry, = self.entries()
+        self.assertEqual((entry["tool"], entry["func"]), ("Echo", "Echo"))
+
+    def test_unwritable_log(self):
+        RecordedHelp.record = rf.Recorder(os.path.join(self.log, "x.log"))
+        with open(self.log, "w"):
+            pass
+        ret = rf.run(echo, RecordedHelp(), ['-c', '2', '-i', self.input],
+                        check=False)
+        self.assertEqual(ret, 2)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual([rf.Report.percentile(values, p) for p in
+                            (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(rf.Report.percentile([3], 99), 3)
+
+class WatchTest(BaseTest):
+    def setUp(self):
+        super(WatchTest, self).setUp()
+        base = os.path.dirname(__file__)
+        self.input = os.path.join(base, "watch.txt")
+        self.other = os.path.join(base, "watch-other.txt")
+        for path in (self.input, self.other):
+            with open(path, "w") as handle:
+                handle.write("first")
+        self.watch = rf.Watch(delay=0.05, interval=0.05)
+        self.calls = []
+
+    def tearDown(self):
+        for path in (self.input, self.other):
+            os.remove(path)
+        super(WatchTest, self).tearDown()
+
+    def start(self):
+        arg = self.watch
+        class Help(rf.Help):
+            infile = rf.Stream("r", "Input", opt='i')
+            other = rf.Stream("r", "Other input", opt='o')
+            watch = arg
+        def func(infile=None, other=None):
+            self.calls.append((infile.read(), id(other), other.read()))
+            return len(self.calls)
+        argv = ['-i', self.input, '-o', self.other, '--watch']
+        self.result = []
+        thread = threading.Thread(target=lambda: self.result.append(
+            rf.run(func, Help(), argv=argv, check=False)))
+        thread.start()
+        return thread
+
+    def wait_for(self, count):
+        for i in range(100):
+            if len(self.calls) >= count:
+                return
+            time.sleep(0.02)
+
+    def check(self):
+        thread = self.start()
+        try:
+            self.wait_for(1)
+            time.sleep(0.1)
+            with open(self.input, "w") as handle:
+                handle.write("second")
+            self.wait_for(2)
+        finally:
+            self.watch.stop()
+            thread.join()
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual([call[0] for call in self.calls], ["first", "second"])
+        self.assertEqual(self.calls[0][1:], self.calls[1][1:])
+        self.assertEqual(self.result, [2])
+
+    def test_inotify(self):
+        if rf._libc is None:
+            return
+        self.check()
+
+    def test_polling(self):
+        libc, rf._libc = rf._libc, None
+        try:
+            self.check()
+        finally:
+            rf._libc = libc
+
+    def test_shard(self):
+        lines = ["line %d\n" % i for i in range(20)]
+        for path in (self.input, self.other):
+            with open(path, "w") as handle:
+                handle.write(''.join(lines))
+        arg = self.watch
+        class Help(rf.Help):
+            infile = rf.Stream("r", "Input", opt='i')
+            other = rf.Stream("r", "Other input", opt='o')
+            shard = rf.Shard()
+            watch = arg
+        def func(infile=None, other=None):
+            self.calls.append((list(infile), list(other)))
+        argv = ['-i', self.input, '-o', self.other, '--shard', '1/3',
+                '--watch']
+        thread = threading.Thread(target=rf.run, args=(func, Help(), argv),
+                                    kwargs={"check": False})
+        thread.start()
+        try:
+            self.wait_for(1)
+            time.sleep(0.1)
+            with open(self.input, "w") as handle:
+                handle.write(''.join(lines[:10]))
+            self.wait_for(2)
+        finally:
+            self.watch.stop()
+            thread.join()
+        expect = [line for line in lines if rf.shard_hash(line) % 3 == 1]
+        self.assertEqual(self.calls, [(expect, expect),
+                                        (expect[:len(expect) // 2], expect)])
+
+    def check_outputs(self):
+        base = os.path.join(os.path.dirname(__file__), "watched")
+        os.mkdir(base)
+        try:
+            self.watch_outputs(base)
+        finally:
+            shutil.rmtree(base)
+
+    def watch_outputs(self, base):
+        with open(os.path.join(base, "a.txt"), "w") as handle:
+            handle.write("a")
+        arg = self.watch
+        class Help(rf.Help):
+            files = rf.Glob(rf.FILE, "Inputs", opt='f')
+            out = rf.Stream("w", "Output", opt='o', atomic=True)
+            log = rf.Stream("w", "Log", opt='l')
+            watch = arg
+        def func(files=None, out=None, log=None):
+            names = sorted(os.path.basename(path) for path in files)
+            self.calls.append(names)
+            out.write(' '.join(names))
+            log.write(' '.join(names))
+        argv = ['-f', os.path.join(base, '*.txt'), '-o',
+                os.path.join(base, 'out'), '-l', os.path.join(base, 'log'),
+                '--watch']
+        del self.calls[:]
+        thread = threading.Thread(target=rf.run, args=(func, Help(), argv),
+                                    kwargs={"check": False})
+        thread.start()
+        try:
+            self.wait_for(1)
+            time.sleep(0.3)
+            self.assertEqual(len(self.calls), 1)
+            with open(os.path.join(base, "b.txt"), "w") as handle:
+                handle.write("b")
+            self.wait_for(2)
+            time.sleep(0.3)
+        finally:
+            self.watch.stop()
+            thread.join()
+        self.assertEqual(self.calls, [["a.txt"], ["a.txt", "b.txt"]])
+
+    def test_outputs(self):
+        if rf._libc is not None:
+            self.check_outputs()
+        libc, rf._libc = rf._libc, None
+        try:
+            self.check_outputs()
+        finally:
+            rf._libc = libc
+
+    def test_debounce(self):
+        paths = set([self.input])
+        stop = threading.Event()
+        def writer():
+            for i in range(5):
+                time.sleep(0.02)
+                with open(self.input, "w") as handle:
+                    handle.write("x" * (i + 2))
+        for files in (rf.StatWatcher(0.01), rf.watcher(0.01)):
+            thread = threading.Thread(target=writer)
+            thread.start()
+            self.assertEqual(files.wait(paths, 0.2, stop), paths)
+            thread.join()
+            files.close()
+
+    def test_stop(self):
+        stop = threading.Event()
+        stop.set()
+        self.assertEqual(rf.watcher().wait(set([self.input]), 0.1, stop),
+                            None)
+
+class HelpCacheTest(BaseTest):
+    def setUp(self):
+        super(HelpCacheTest, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        rf._HELP_INDEX.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        rf._HELP_INDEX.clear()
+        super(HelpCacheTest, self).tearDown()
+
+    def parser(self, desc="The first option."):
+        class Help(rf.Help):
+            """\
+            A tool.
+            """
+            help_cache = self.dir
+            alpha = rf.Check(int, desc, opt='a')
+            beta = rf.Flag("The beta flag.")
+            gamma = rf.Choice(["x", "y"], "Pick a letter.")
+        def func(alpha=1, beta=False, gamma="x"):
+            pass
+        return rf.Parser(func, Help())
+
+    def test_page(self):
+        parser = self.parser()
+        expect = parser.format_help(parser.formatter)
+        self.assertEqual(self.parser().format_help(), expect)
+        self.assertEqual(len(os.listdir(self.dir)), 1)
+
+    def test_disk(self):
+        expect = self.parser().format_help()
+        rf._HELP_INDEX.clear()
+        parser = self.parser()
+        def fail():
+            raise AssertionError("Rendered again")
+        parser.render_help = fail
+        self.assertEqual(parser.format_help(), expect)
+
+    def test_invalidates(self):
+        self.parser().format_help()
+        page = self.parser("Changed.").format_help()
+        self.assertEqual("Changed." in page, True)
+        self.assertEqual(len(os.listdir(self.dir)), 2)
+
+    def test_matching(self):
+        parser = self.parser()
+        self.assertEqual(len(parser.matching_help("alpha")), 1)
+        self.assertEqual(len(parser.matching_help("-a")), 1)
+        self.assertEqual(len(parser.matching_help("--*a")), 3)
+        self.assertEqual(len(parser.matching_help("LETTER")), 1)
+        self.assertEqual(parser.matching_help("delta"), [])
+
+    def test_option(self):
+        parser = self.parser()
+        self.assertRaises(SystemExit, parser.parse, ['--help=beta'])
+        out = sys.stdout.getvalue()
+        self.assertEqual(out.startswith("Options matching 'beta':"), True)
+        self.assertEqual("The beta flag." in out, True)
+        self.assertEqual("first option" in out, False)
+
+    def test_formatter(self):
+        parser = self.parser()
+        key = parser.help_key()
+        parser.formatter = op.TitledHelpFormatter()
+        self.assertNotEqual(parser.help_key(), key)
+
+    def test_version(self):
+        key = self.parser().help_key()
+        version, rf.__version__ = rf.__version__, "0.0.0"
+        try:
+            self.assertNotEqual(self.parser().help_key(), key)
+        finally:
+            rf.__version__ = version
+
+    def test_option_named_cache(self):
+        class Help(rf.Help):
+            help_cache = rf.Flag("Cache things.")
+        parser = rf.Parser(lambda help_cache=False: None, Help())
+        self.assertEqual(parser.help_path("key"),
+                            os.path.join(rf.cache_dir(), "help", "key.json"))
+
+    def test_default_dir(self):
+        self.assertEqual(rf.cache_dir().startswith(CACHE_HOME), True)
+
+class CountingStream(object):
+    def __init__(self):
+        self.writes = []
+    def write(self, data):
+        self.writes.append(data)
+    def flush(self):
+        pass
+
+class OutputTest(BaseTest):
+    def setUp(self):
+        super(OutputTest, self).setUp()
+        class Help(rf.Help):
+            count = rf.Check(int, "Count", opt='c')
+            out = rf.Stream("w", "Output", opt='o')
+        self.help = Help
+
+    def invoke(self, output, argv=()):
+        self.help.output = output
+        self.stream = CountingStream()
+        def func(count=3, out=self.stream):
+            return (row for row in [(i, "x%d" % i) for i in range(count)])
+        return rf.run(func, self.help(), argv=list(argv), check=False)
+
+    def test_lines(self):
+        self.assertEqual(self.invoke(rf.Output()), 3)
+        self.assertEqual(sys.stdout.getvalue(),
+                            "(0, 'x0')\n(1, 'x1')\n(2, 'x2')\n")
+
+    def test_jsonl(self):
+        self.invoke(rf.Output("jsonl", dest="out"))
+        self.assertEqual(self.stream.writes,
+                            ['[0, "x0"]\n[1, "x1"]\n[2, "x2"]\n'])
+
+    def test_csv(self):
+        self.invoke(rf.Output("csv", dest="out"), ['-c', '2'])
+        self.assertEqual(self.stream.writes, ['0,x0\r\n1,x1\r\n'])
+
+    def test_custom(self):
+        def fmt(items):
+            return ''.join("%s;" % item[0] for item in items)
+        self.invoke(rf.Output(fmt, dest="out"))
+        self.assertEqual(self.stream.writes, ['0;1;2;'])
+
+    def test_batching(self):
+        output = rf.Output("jsonl", dest="out", bufsize=40, batch=10)
+        self.assertEqual(self.invoke(output, ['-c', '25']), 25)
+        self.assertEqual(len(self.stream.writes), 3)
+        data = ''.join(self.stream.writes).splitlines()
+        self.assertEqual(data[0], '[0, "x0"]')
+        self.assertEqual(data[-1], '[24, "x24"]')
+
+    def test_not_iterator(self):
+        self.help.output = rf.Output()
+        ret = rf.run(lambda count=1: [count], self.help(), argv=[],
+                        check=False)
+        self.assertEqual(ret, [1])
+
+    def test_bad_format(self):
+        self.assertRaises(ValueError, rf.Output, "xml")
+
+    def test_option_named_output(self):
+        class Help(rf.Help):
+            output = rf.Stream("w", "Output", opt='o')
+        stream = CountingStream()
+        def func(output=stream):
+            return iter([1, 2])
+        ret = rf.run(func, Help(), argv=[], check=False)
+        self.assertEqual(list(ret), [1, 2])
+        self.assertEqual(stream.writes, [])
+
 class RunTest(BaseTest):
     def setUp(self):
         super(RunTest, self).setUp()
@@ -452,6 +1993,15 @@ class RunTest(BaseTest):
         self.assertRaises(
             TypeError, rf.run, func, self.help(), argv=1, check=False
         )
+        self.assertRaises(
+            TypeError, rf.run, func, self.help(), argv="2", check=False
+        )
+
+    def test_iterable_argv(self):
+        func = lambda foo, bar=False: (foo, bar)
+        argv = iter(['-b', '3'])
+        ret = rf.run(func, self.help(), argv=argv, check=False)
+        self.assertEqual(ret, (3, True))
 
 class IsMainTest(unittest.TestCase):
     def test_basic(self):